@@ -2,26 +2,117 @@
 ---- app.py
 """
 
+import logging
+import math
+import os
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from functools import wraps
-from flask import Flask, jsonify, request, Response, current_app, g
-from flask.json import JSONEncoder
-from sqlalchemy import create_engine, text
-import bcrypt
+from hashlib import sha256
+from itertools import islice
+from time import time
+import click
+from flask import (
+    Flask,
+    jsonify,
+    request,
+    Response,
+    current_app,
+    g,
+    has_request_context,
+    stream_with_context,
+)
+from flask.ctx import _AppCtxGlobals
 import jwt
 from flask_cors import CORS
 
+from cache import LRUCache
+from compression import compress_response
+from db_pool import PoolTelemetry, pool_stats
+from home_timeline import HomeTimelineStore
+from json_provider import MiniterJSONProvider
+from metrics import (
+    prometheus_counter,
+    prometheus_counter_family,
+    prometheus_gauge,
+    prometheus_histogram,
+)
+from password import PasswordHasher, PasswordHasherBusy
+from queries import build_queries
+from repository import MemoryRepository, SqlRepository, TIMESTAMP_FORMAT
+from routing import ReadRouter
+from search import rank, tokenize
+from sharding import ShardedRepository
+from social_graph import SocialGraph
+from storage import create_database, metadata, shard_metadata
+from telemetry import RequestTelemetry
+from tweet_queue import TweetQueue
 
-class CustomJSONEncoder(JSONEncoder):
+CURSOR_TIME_FORMAT = TIMESTAMP_FORMAT
+
+# cookie a client carries for READ_YOUR_WRITES_SECONDS after its own write
+READ_PRIMARY_COOKIE = "miniter_read_primary"
+
+logger = logging.getLogger("miniter")
+LOG_FORMAT = "time=%(asctime)s level=%(levelname)s %(message)s"
+
+
+class MiniterGlobals(_AppCtxGlobals):
+    """
+    g with a lazily loaded user
+
+    g.user is only fetched when a handler reads it.
     """
-    Custom Json Encoder
+
+    @property
+    def user(self):
+        if "_user" not in self.__dict__:
+            user_id = self.__dict__.get("user_id")
+            self._user = get_user(user_id) if user_id else None
+
+        return self._user
+
+
+def verify_token(access_token, app=None):
+    """
+    verified jwt payload of access_token, or None
+
+    recently verified tokens are served from app.token_cache until the
+    earlier of their exp and TOKEN_CACHE_TTL.
     """
+    app = current_app if app is None else app
+    token_key = sha256(access_token.encode("UTF-8")).digest()
+    payload = app.token_cache.get(token_key)
+    if payload is not None:
+        return payload
 
-    def default(self, obj):
-        if isinstance(obj, set):
-            return list(obj)
+    try:
+        payload = jwt.decode(access_token, app.jwt_key, "HS256")
+    except jwt.InvalidTokenError:
+        return None
 
-        return JSONEncoder.default(self, obj)
+    ttl = app.config.get("TOKEN_CACHE_TTL", 60)
+    if "exp" in payload:
+        ttl = min(ttl, payload["exp"] - time())
+    if ttl > 0:
+        app.token_cache.set(token_key, payload, ttl)
+
+    return payload
+
+
+def issue_token(user_id, app=None):
+    """
+    access token for user_id, valid for a day
+    """
+    app = current_app if app is None else app
+    payload = {
+        "user_id": user_id,
+        "exp": datetime.utcnow() + timedelta(seconds=60 * 60 * 24),
+    }
+
+    return jwt.encode(payload, app.jwt_key, "HS256")
 
 
 def login_required(f):
@@ -33,19 +124,13 @@ def login_required(f):
     def decorated_function(*args, **kwargs):
         access_token = request.headers.get("Authorization")
         if access_token is not None:
-            try:
-                payload = jwt.decode(
-                    access_token, current_app.config["JWT_SECRET_KEY"], "HS256"
-                )
-            except jwt.InvaildTokenError:
-                payload = None
+            payload = verify_token(access_token)
 
-            if payload is None:
+            if payload is None or "user_id" not in payload:
                 return Response(status=401)
 
             user_id = payload["user_id"]
             g.user_id = user_id
-            g.user = get_user(user_id) if user_id else None
         else:
             return Response(status=401)
 
@@ -54,139 +139,782 @@ def login_required(f):
     return decorated_function
 
 
+def reader(user_id=None):
+    """
+    repository for reads: the primary for a user (user_id, else the logged
+    in one) who has just written or a client carrying the read-primary
+    cookie, else the replica picked for this request
+
+    every read of a request goes to the same replica, so e.g. a timeline's
+    ETag and body describe the same replication state.
+    """
+    router = current_app.read_router
+    if router.pinned(user_id if user_id is not None else g.get("user_id")):
+        return router.primary
+    if router.replicas and reads_primary():
+        return router.primary
+
+    if "replica" not in g:
+        g.replica = router.reader()
+
+    return g.replica
+
+
+def reads_primary():
+    """
+    whether the client carries a live read-primary cookie
+
+    the router's window is per process; the cookie carries it to whichever
+    worker serves the client's next request.
+    """
+    if not has_request_context():
+        return False
+
+    if "read_primary" not in g:
+        token = request.cookies.get(READ_PRIMARY_COOKIE)
+        try:
+            payload = jwt.decode(token, current_app.jwt_key, "HS256") if token else {}
+        except jwt.InvalidTokenError:
+            payload = {}
+        g.read_primary = payload.get("read_primary_until", 0) > time()
+
+    return g.read_primary
+
+
+def wrote(user_id):
+    """
+    pin user_id's reads to the primary for a while after a write
+    """
+    current_app.read_router.wrote(user_id)
+    if current_app.read_router.replicas and has_request_context():
+        g.wrote_at = time()
+
+
+def set_read_primary_cookie(response):
+    """
+    after a write, have the client read from the primary for the window
+    """
+    wrote_at = g.pop("wrote_at", None)
+    if wrote_at is None:
+        return response
+
+    window = current_app.config.get("READ_YOUR_WRITES_SECONDS", 5)
+    # no user_id in the payload: it must not pass for an access token
+    token = jwt.encode(
+        {"read_primary_until": wrote_at + window}, current_app.jwt_key, "HS256"
+    )
+    response.set_cookie(
+        READ_PRIMARY_COOKIE,
+        token,
+        max_age=math.ceil(window),
+        httponly=True,
+        samesite="Lax",
+    )
+
+    return response
+
+
 def get_user(user_id):
     """
     user get function
     """
-    user = current_app.database.execute(
-        text(
-            """
-        SELECT
-            id,
-            name,
-            email,
-            profile
-        FROM users
-        WHERE id = :user_id
-    """
-        ),
-        {"user_id": user_id},
-    ).fetchone()
+    user = current_app.user_cache.get(user_id)
+    if user is not None:
+        return dict(user)
 
-    return (
-        {
-            "id": user["id"],
-            "name": user["name"],
-            "email": user["email"],
-            "profile": user["profile"],
-        }
-        if user
-        else None
-    )
+    user = reader(user_id).get_user(user_id)
+
+    if user is None:
+        return None
+
+    user = {
+        "id": user["id"],
+        "name": user["name"],
+        "email": user["email"],
+        "profile": user["profile"],
+    }
+    current_app.user_cache.set(user_id, user)
+
+    return dict(user)
 
 
 def insert_user(user):
     """
     user insert function
     """
-    return current_app.database.execute(
-        text(
-            """
-        INSERT INTO users (
-            name,
-            email,
-            profile,
-            hashed_password
-        ) VALUES (
-            :name,
-            :email,
-            :profile,
-            :password
-        )
-    """
-        ),
-        user,
-    ).lastrowid
+    user_id = current_app.repository.insert_user(user)
+    current_app.user_cache.invalidate(user_id)
+    wrote(user_id)
+
+    return user_id
 
 
 def insert_tweet(user_tweet):
     """
     tweet fucntion
     """
-    return current_app.database.execute(
-        text(
-            """
-        INSERT INTO tweets (
-            user_id,
-            tweet
-        ) VALUES (
-            :id,
-            :tweet
-        )
+    tweet_id = current_app.repository.insert_tweet(
+        user_tweet["id"], user_tweet["tweet"]
+    )
+    wrote(user_tweet["id"])
+
+    if current_app.home_timeline is not None:
+        fan_out_tweet(user_tweet["id"], tweet_id)
+
+    return tweet_id
+
+
+def queued_tweets_stored(user_ids):
+    """
+    bookkeeping of write-behind tweets once the queue writer stored them
     """
-        ),
-        user_tweet,
-    ).rowcount
+    for user_id in user_ids:
+        wrote(user_id)
+        if current_app.home_timeline is not None:
+            invalidate_home_timelines(user_id)
+
+
+def invalidate_home_timelines(user_id):
+    """
+    drop the materialized home timelines a new tweet of user_id belongs in;
+    they are rebuilt from the tweets table on their next read
+    """
+    store = current_app.home_timeline
+    threshold = current_app.config.get("CELEBRITY_FOLLOWER_THRESHOLD", 10000)
+    follower_ids = get_follower_ids(user_id, threshold)
+
+    store.invalidate(user_id)
+    if len(follower_ids) < threshold:
+        for follower_id in follower_ids:
+            store.invalidate(follower_id)
+
+
+def insert_tweets(user_id, tweets):
+    """
+    batch tweet function
+
+    writes all tweets with one executemany in a single transaction.
+    """
+    rowcount, tweet_ids = current_app.repository.insert_tweets(
+        user_id, tweets, with_ids=current_app.home_timeline is not None
+    )
+    wrote(user_id)
+
+    for tweet_id in tweet_ids:
+        fan_out_tweet(user_id, tweet_id)
+
+    return rowcount
 
 
 def insert_follow(user_follow):
     """
     follow function
     """
-    return current_app.database.execute(
-        text(
-            """
-        INSERT INTO users_follow_list (
-            user_id,
-            follow_user_id
-        ) VALUES (
-            :id,
-            :follow
-        )
-    """
-        ),
-        user_follow,
-    ).rowcount
+    rowcount = current_app.repository.insert_follow(
+        user_follow["id"], user_follow["follow"]
+    )
+    wrote(user_follow["id"])
+
+    if rowcount and current_app.social_graph is not None:
+        current_app.social_graph.follow(user_follow["id"], user_follow["follow"])
+    if current_app.home_timeline is not None:
+        current_app.home_timeline.invalidate(user_follow["id"])
+
+    return rowcount
 
 
 def insert_unfollow(user_unfollow):
     """
     unfollow function
     """
-    return current_app.database.execute(
-        text(
-            """
-        DELETE FROM users_follow_list
-        WHERE user_id = :id
-        AND follow_user_id = :unfollow
+    rowcount = current_app.repository.delete_follow(
+        user_unfollow["id"], user_unfollow["unfollow"]
+    )
+    wrote(user_unfollow["id"])
+
+    if rowcount and current_app.social_graph is not None:
+        current_app.social_graph.unfollow(
+            user_unfollow["id"], user_unfollow["unfollow"]
+        )
+    if current_app.home_timeline is not None:
+        current_app.home_timeline.invalidate(user_unfollow["id"])
+
+    return rowcount
+
+
+def insert_follows(user_id, follow_user_ids):
+    """
+    batch follow function
+
+    returns the number of follows actually added; existing follows and
+    unknown users are skipped.
     """
-        ),
-        user_unfollow,
-    ).rowcount
+    rowcount = current_app.repository.insert_follows(user_id, follow_user_ids)
+    wrote(user_id)
+
+    if rowcount and current_app.social_graph is not None:
+        current_app.social_graph.invalidate(user_id, follow_user_ids)
+    if current_app.home_timeline is not None:
+        current_app.home_timeline.invalidate(user_id)
+
+    return rowcount
 
 
-def get_timeline(user_id):
+def insert_unfollows(user_id, unfollow_user_ids):
+    """
+    batch unfollow function
+
+    returns the number of follows actually removed.
+    """
+    rowcount = current_app.repository.delete_follows(user_id, unfollow_user_ids)
+    wrote(user_id)
+
+    if rowcount and current_app.social_graph is not None:
+        current_app.social_graph.invalidate(user_id, unfollow_user_ids)
+    if current_app.home_timeline is not None:
+        current_app.home_timeline.invalidate(user_id)
+
+    return rowcount
+
+
+def user_id_list(payload, key):
+    """
+    list of user ids under key of a batch request body
+    """
+    user_ids = payload.get(key) if isinstance(payload, dict) else None
+    if not isinstance(user_ids, list) or not all(
+        isinstance(user_id, int) for user_id in user_ids
+    ):
+        raise ValueError(f"{key} must be a list of user ids")
+    if len(user_ids) > current_app.config.get("FOLLOW_BATCH_MAX_SIZE", 1000):
+        raise ValueError(f"too many {key} user ids")
+
+    return sorted(set(user_ids))
+
+
+def encode_cursor(created_at, tweet_id):
+    """
+    timeline cursor encode function
+    """
+    if isinstance(created_at, datetime):
+        created_at = created_at.strftime(CURSOR_TIME_FORMAT)
+
+    return urlsafe_b64encode(f"{created_at}|{tweet_id}".encode("UTF-8")).decode(
+        "UTF-8"
+    )
+
+
+def decode_cursor(cursor):
+    """
+    timeline cursor decode function
+    """
+    try:
+        created_at, tweet_id = (
+            urlsafe_b64decode(cursor.encode("UTF-8")).decode("UTF-8").split("|")
+        )
+        datetime.strptime(created_at, CURSOR_TIME_FORMAT)
+        return created_at, int(tweet_id)
+    except (ValueError, UnicodeError):
+        raise ValueError(f"invalid cursor: {cursor}")
+
+
+def get_followee_ids(user_id):
+    """
+    followee id list get function
+    """
+    if current_app.social_graph is not None:
+        return current_app.social_graph.followee_ids(user_id)
+
+    return reader().get_followee_ids(user_id)
+
+
+def get_follower_ids(user_id, limit=None):
+    """
+    follower id list get function (at most limit ids)
+    """
+    graph = current_app.social_graph
+    if graph is not None:
+        if limit is None:
+            return graph.follower_ids(user_id)
+
+        # a capped read (the celebrity check) does not load a whole list
+        follower_ids = graph.cached_follower_ids(user_id)
+        if follower_ids is not None:
+            return follower_ids[:limit]
+
+    return reader().get_follower_ids(user_id, limit)
+
+
+def get_follower_counts(user_ids):
+    """
+    follower count get function
+    """
+    return reader().get_follower_counts(user_ids)
+
+
+def get_tweets(tweet_ids):
+    """
+    tweets get function by primary key, newest first
+    """
+    return reader().get_tweets(tweet_ids)
+
+
+def query_timeline(user_ids, limit, before=None):
+    """
+    fan-out-on-read: newest tweets of user_ids
+    """
+    return reader().get_timeline(user_ids, limit, before)
+
+
+def fan_out_tweet(user_id, tweet_id):
+    """
+    fan-out-on-write: push a new tweet to the followers' home timelines
+
+    celebrities skip the push and are merged in at read time.
+    """
+    store = current_app.home_timeline
+    threshold = current_app.config.get("CELEBRITY_FOLLOWER_THRESHOLD", 10000)
+    follower_ids = get_follower_ids(user_id, threshold)
+
+    if len(follower_ids) >= threshold:
+        store.mark_celebrities([user_id])
+        store.push([user_id], tweet_id)
+    else:
+        store.push([user_id, *follower_ids], tweet_id)
+
+
+def materialize_home_timeline(user_id):
+    """
+    build user_id's home timeline from the tweets table
+    """
+    store = current_app.home_timeline
+    threshold = current_app.config.get("CELEBRITY_FOLLOWER_THRESHOLD", 10000)
+    followee_ids = get_followee_ids(user_id)
+    follower_counts = get_follower_counts(followee_ids) if followee_ids else {}
+
+    store.mark_celebrities(
+        [
+            followee_id
+            for followee_id, count in follower_counts.items()
+            if count >= threshold
+        ]
+    )
+    celebrity_ids = store.celebrities_in(followee_ids)
+    user_ids = sorted({user_id, *followee_ids} - celebrity_ids)
+    return store.put(
+        user_id, [row["id"] for row in query_timeline(user_ids, store.max_length)]
+    )
+
+
+def get_home_timeline(user_id, limit, before=None):
+    """
+    timeline read from the fan-out-on-write store
+
+    returns None when the page reaches past what the store still holds.
+    """
+    store = current_app.home_timeline
+    tweet_ids, complete = store.get(user_id) or materialize_home_timeline(user_id)
+
+    if before is not None:
+        tweet_ids = [tweet_id for tweet_id in tweet_ids if tweet_id < before[1]]
+    if len(tweet_ids) < limit and not complete:
+        return None
+
+    timeline = get_tweets(tweet_ids[:limit]) if tweet_ids else []
+
+    celebrity_ids = store.celebrities_in(get_followee_ids(user_id))
+    celebrity_ids.discard(user_id)
+    if celebrity_ids:
+        merged = {
+            tweet["id"]: tweet
+            for tweet in [
+                *timeline,
+                *query_timeline(sorted(celebrity_ids), limit, before),
+            ]
+        }
+        timeline = sorted(
+            merged.values(),
+            key=lambda tweet: (tweet["created_at"], tweet["id"]),
+            reverse=True,
+        )
+
+    return timeline[:limit]
+
+
+def get_timeline(user_id, limit, before=None, followee_ids=None):
     """
     timeline get funtion
+
+    returns one page of tweets, newest first, and the cursor of the next page.
+    """
+    timeline = None
+    if current_app.home_timeline is not None:
+        timeline = get_home_timeline(user_id, limit + 1, before)
+    if timeline is None:
+        if followee_ids is None:
+            followee_ids = get_followee_ids(user_id)
+        user_ids = sorted({user_id, *followee_ids})
+        timeline = query_timeline(user_ids, limit + 1, before)
+
+    return page_of(timeline, limit)
+
+
+def timeline_page_args(args=None, config=None):
+    """
+    parse limit and before query parameters of timeline
+    """
+    args = request.args if args is None else args
+    config = current_app.config if config is None else config
+    limit = args.get("limit", config.get("TIMELINE_PAGE_SIZE", 50), type=int)
+    if limit is None or limit < 1:
+        raise ValueError("limit must be a positive integer")
+    limit = min(limit, config.get("TIMELINE_MAX_PAGE_SIZE", 200))
+
+    before = args.get("before")
+
+    return limit, decode_cursor(before) if before else None
+
+
+def page_of(timeline, limit):
+    """
+    first limit rows of timeline (fetched with limit + 1) and next cursor
     """
-    timeline = current_app.database.execute(
-        text(
-            """
-        SELECT 
-            t.user_id,
-            t.tweet
-        FROM tweets t
-        LEFT JOIN users_follow_list ufl ON ufl.user_id = :user_id
-        WHERE t.user_id = :user_id 
-        OR t.user_id = ufl.follow_user_id
-    """
-        ),
-        {"user_id": user_id},
-    ).fetchall()
+    next_cursor = None
+    if len(timeline) > limit:
+        timeline = timeline[:limit]
+        next_cursor = encode_cursor(timeline[-1]["created_at"], timeline[-1]["id"])
 
     return [
         {"user_id": tweet["user_id"], "tweet": tweet["tweet"]} for tweet in timeline
-    ]
+    ], next_cursor
+
+
+def timeline_response(user_id):
+    """
+    paginated timeline response
+    """
+    try:
+        limit, before = timeline_page_args()
+    except ValueError as e:
+        return str(e), 400
+
+    followee_ids = get_followee_ids(user_id)
+    etag, last_modified = timeline_validators(user_id, followee_ids)
+    if request.if_none_match.contains_weak(etag):
+        return conditional(Response(status=304), etag, last_modified)
+
+    timeline, next_cursor = get_timeline(user_id, limit, before, followee_ids)
+
+    return conditional(
+        jsonify({"user_id": user_id, "timeline": timeline, "next_cursor": next_cursor}),
+        etag,
+        last_modified,
+    )
+
+
+def timeline_validators(user_id, followee_ids):
+    """
+    (ETag, Last-Modified) of a timeline page
+
+    the tag hashes the follow list, the newest tweet of every author (one
+    index dive per author, never a sort of their tweets) and the query
+    string, so it changes whenever the page could. Last-Modified is the
+    newest tweet's time; it is informative only, as an unfollow leaves no
+    timestamp behind.
+    """
+    user_ids = sorted({user_id, *followee_ids})
+    heads = sorted(
+        (row["user_id"], row["id"], row["created_at"])
+        for row in reader().get_timeline_heads(user_ids)
+    )
+    head_ids = [(author_id, tweet_id) for author_id, tweet_id, _ in heads]
+    created_at = max((created_at for *_, created_at in heads), default=None)
+    if isinstance(created_at, str):
+        created_at = datetime.strptime(created_at, TIMESTAMP_FORMAT)
+
+    etag = sha256(
+        f"{user_id}|{user_ids}|{head_ids}|{created_at}|".encode("UTF-8")
+        + request.query_string
+    ).hexdigest()[:32]
+
+    return etag, created_at
+
+
+def conditional(response, etag, last_modified):
+    """
+    set the caching validators of a timeline response
+    """
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add("Accept")
+
+    return response
+
+
+def follow_page_args():
+    """
+    parse limit and after query parameters of follow lists
+    """
+    config = current_app.config
+    limit = request.args.get("limit", config.get("FOLLOW_PAGE_SIZE", 100), type=int)
+    if limit is None or limit < 1:
+        raise ValueError("limit must be a positive integer")
+    limit = min(limit, config.get("FOLLOW_MAX_PAGE_SIZE", 1000))
+
+    after = request.args.get("after")
+    if after is not None and not after.isdigit():
+        raise ValueError("after must be a user id")
+
+    return limit, int(after) if after is not None else None
+
+
+def get_follow_page(user_id, key, after, limit):
+    """
+    up to limit ids, ascending and above after, of user_id's followees
+    (key "following") or followers
+
+    keyset paginated in SQL, so a page costs its size, not the list's;
+    the cached graph arrays are bisected instead when the graph is on.
+    """
+    graph = current_app.social_graph
+    following = key == "following"
+    if graph is not None:
+        user_ids = (
+            graph.followee_ids(user_id) if following else graph.follower_ids(user_id)
+        )
+        start = bisect_right(user_ids, after) if after is not None else 0
+        return list(user_ids[start : start + limit])
+
+    repository = reader()
+    fetch = repository.get_followee_page if following else repository.get_follower_page
+
+    return fetch(user_id, after if after is not None else 0, limit)
+
+
+def follow_list_response(user_id, key):
+    """
+    one page of user_id's sorted followees or followers, after the id
+    given in after
+    """
+    try:
+        limit, after = follow_page_args()
+    except ValueError as e:
+        return str(e), 400
+
+    if get_user(user_id) is None:
+        return "user not found", 404
+
+    page = get_follow_page(user_id, key, after, limit + 1)
+    next_after = page[limit - 1] if len(page) > limit else None
+
+    return jsonify({"user_id": user_id, key: page[:limit], "next_after": next_after})
+
+
+def encode_search_cursor(score, tweet_id):
+    """
+    search cursor encode function
+    """
+    return urlsafe_b64encode(f"{score!r}|{tweet_id}".encode("UTF-8")).decode("UTF-8")
+
+
+def decode_search_cursor(cursor):
+    """
+    search cursor decode function
+    """
+    try:
+        score, tweet_id = (
+            urlsafe_b64decode(cursor.encode("UTF-8")).decode("UTF-8").split("|")
+        )
+        return float(score), int(tweet_id)
+    except (ValueError, UnicodeError):
+        raise ValueError(f"invalid cursor: {cursor}")
+
+
+def search_page_args():
+    """
+    parse q, limit and after query parameters of search
+    """
+    config = current_app.config
+    terms = tokenize(request.args.get("q", ""))
+    if not terms:
+        raise ValueError("q must contain a search term")
+
+    limit = request.args.get("limit", config.get("SEARCH_PAGE_SIZE", 20), type=int)
+    if limit is None or limit < 1:
+        raise ValueError("limit must be a positive integer")
+    limit = min(limit, config.get("SEARCH_MAX_PAGE_SIZE", 100))
+
+    after = request.args.get("after")
+
+    return (
+        terms[: config.get("SEARCH_MAX_TERMS", 8)],
+        limit,
+        decode_search_cursor(after) if after else None,
+    )
+
+
+def search_tweets(terms, limit, after=None):
+    """
+    one page of the tweets matching terms, best first, and the next cursor
+
+    only the newest SEARCH_MAX_POSTINGS postings of each term are ranked,
+    which bounds the work per query whatever the number of tweets.
+    """
+    max_postings = current_app.config.get("SEARCH_MAX_POSTINGS", 1000)
+    repository = reader()
+    scores = rank(
+        {term: repository.get_term_postings(term, max_postings) for term in terms},
+        max_postings,
+    )
+
+    ranked = sorted(
+        ((score, tweet_id) for tweet_id, score in scores.items()), reverse=True
+    )
+    if after is not None:
+        ranked = [key for key in ranked if key < after]
+    page = ranked[:limit]
+
+    tweets = {
+        tweet["id"]: tweet
+        for tweet in (get_tweets([tweet_id for _, tweet_id in page]) if page else [])
+    }
+    next_cursor = encode_search_cursor(*page[-1]) if len(ranked) > limit else None
+
+    return [
+        {"user_id": tweets[tweet_id]["user_id"], "tweet": tweets[tweet_id]["tweet"]}
+        for _, tweet_id in page
+        if tweet_id in tweets
+    ], next_cursor
+
+
+def wants_stream():
+    """
+    True when the client asks for the timeline as NDJSON
+    """
+    return request.args.get("stream") == "1" or (
+        request.accept_mimetypes.best_match(
+            ["application/json", "application/x-ndjson"]
+        )
+        == "application/x-ndjson"
+    )
+
+
+def stream_timeline(user_id, before=None):
+    """
+    whole timeline of user_id as NDJSON chunks, newest first
+
+    rows come off a streaming cursor batch by batch, so memory and time to
+    first byte do not grow with the timeline.
+    """
+    batch_size = current_app.config.get("TIMELINE_STREAM_BATCH_SIZE", 500)
+    user_ids = sorted({user_id, *get_followee_ids(user_id)})
+
+    return ndjson_chunks(
+        reader().iter_timeline(user_ids, before, batch_size),
+        batch_size,
+    )
+
+
+def ndjson_chunks(rows, batch_size):
+    """
+    one NDJSON line per timeline row, batch_size lines per chunk; each line
+    carries the cursor that resumes the stream after it
+    """
+    dumps = current_app.json.dumps
+    try:
+        while True:
+            chunk = "".join(
+                dumps(
+                    {
+                        "user_id": row["user_id"],
+                        "tweet": row["tweet"],
+                        "cursor": encode_cursor(row["created_at"], row["id"]),
+                    }
+                )
+                + "\n"
+                for row in islice(rows, batch_size)
+            )
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        rows.close()
+
+
+def timeline_stream_response(user_id):
+    """
+    chunked NDJSON timeline response
+    """
+    before = request.args.get("before")
+    try:
+        before = decode_cursor(before) if before else None
+    except ValueError as e:
+        return str(e), 400
+
+    return Response(
+        stream_with_context(stream_timeline(user_id, before)),
+        mimetype="application/x-ndjson",
+    )
+
+
+def busy_response():
+    """
+    503 for a full password hashing queue
+    """
+    return Response(status=503, headers={"Retry-After": "1"})
+
+
+def configure_logging(config):
+    """
+    level (LOG_LEVEL) and stderr handler of the miniter logger
+
+    messages are logfmt key=value pairs; passwords and tokens are never logged.
+    """
+    logger.setLevel(config.get("LOG_LEVEL", "WARNING"))
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(config.get("LOG_FORMAT", LOG_FORMAT)))
+        logger.addHandler(handler)
+
+
+def create_pooled_database(app, config, label, schema=metadata):
+    """
+    create_database with checkout telemetry of its own, reported under
+    label ("primary", "replica0", "shard0", ...) in app.db_pools
+    """
+    telemetry = PoolTelemetry()
+    database = create_database(config, telemetry, schema)
+    app.db_pools[label] = (database, telemetry)
+
+    return database
+
+
+def create_tweet_shards(app):
+    """
+    repositories of the TWEET_SHARD_COUNT logical tweet shards, shard i on
+    TWEET_SHARD_URLS[i % len(TWEET_SHARD_URLS)] (a database shared by
+    several shards holds their tweets in one table)
+    """
+    urls = app.config["TWEET_SHARD_URLS"]
+    count = app.config.get("TWEET_SHARD_COUNT") or len(urls)
+
+    repositories = {}
+    for url in dict.fromkeys(urls):
+        shard_database = create_pooled_database(
+            app,
+            {**app.config, "DB_URL": url},
+            f"shard{len(app.shard_databases)}",
+            shard_metadata,
+        )
+        queries = build_queries(shard_database.dialect.name)
+        app.request_telemetry.instrument_engine(shard_database, queries)
+        app.shard_databases.append(shard_database)
+        repositories[url] = SqlRepository(shard_database, queries)
+
+    return [repositories[urls[shard % len(urls)]] for shard in range(count)]
 
 
 def create_app(test_config=None):
@@ -197,26 +925,259 @@ def create_app(test_config=None):
 
     CORS(app)
 
-    app.json_encoder = CustomJSONEncoder
+    app.json = MiniterJSONProvider(app)
+    app.app_ctx_globals_class = MiniterGlobals
 
     if test_config is None:
         app.config.from_pyfile("config.py")
     else:
         app.config.update(test_config)
 
-    database = create_engine(app.config["DB_URL"], encoding="utf-8", max_overflow=0)
+    configure_logging(app.config)
+
+    app.db_pools = {}
+    app.request_telemetry = RequestTelemetry()
+    app.request_telemetry.instrument_app(app)
+    replicas = []
+    if app.config.get("STORAGE_BACKEND", "sql") == "memory":
+        database = None
+        app.repository = MemoryRepository()
+    else:
+        database = create_pooled_database(app, app.config, "primary")
+        app.queries = build_queries(database.dialect.name)
+        app.repository = SqlRepository(database, app.queries)
+        app.request_telemetry.instrument_engine(database, app.queries)
+
+        for url in app.config.get("DB_REPLICA_URLS") or ():
+            replica = create_pooled_database(
+                app, {**app.config, "DB_URL": url}, f"replica{len(replicas)}"
+            )
+            app.request_telemetry.instrument_engine(replica, app.queries)
+            replicas.append(replica)
     app.database = database
+    app.replica_databases = replicas
+    replica_repositories = [SqlRepository(replica, app.queries) for replica in replicas]
+
+    app.shard_databases = []
+    if database is not None and app.config.get("TWEET_SHARD_URLS"):
+        if app.config.get("HOME_TIMELINE_ENABLED"):
+            # the home timeline store pages by tweet id, which only follows
+            # time within one tweet table
+            raise ValueError(
+                "HOME_TIMELINE_ENABLED does not support TWEET_SHARD_URLS"
+            )
+        shards = create_tweet_shards(app)
+        executor = ThreadPoolExecutor(len(shards), thread_name_prefix="tweet-shard")
+        app.repository = ShardedRepository(app.repository, shards, executor)
+        replica_repositories = [
+            ShardedRepository(replica, shards, executor)
+            for replica in replica_repositories
+        ]
+
+    app.read_router = ReadRouter(
+        app.repository,
+        replica_repositories,
+        app.config.get("READ_YOUR_WRITES_SECONDS", 5),
+    )
+
+    app.jwt_key = app.config["JWT_SECRET_KEY"].encode("UTF-8")
+    app.token_cache = LRUCache(
+        app.config.get("TOKEN_CACHE_SIZE", 4096),
+        app.config.get("TOKEN_CACHE_TTL", 60),
+    )
+
+    app.user_cache = LRUCache(
+        app.config.get("USER_CACHE_SIZE", 1024), app.config.get("USER_CACHE_TTL", 60)
+    )
+
+    app.password_hasher = PasswordHasher(
+        app.config.get("PASSWORD_HASH_WORKERS") or os.cpu_count(),
+        app.config.get("PASSWORD_HASH_QUEUE_SIZE", 64),
+        app.config.get("BCRYPT_ROUNDS", 12),
+        app.config.get("PASSWORD_HASH_TIMEOUT"),
+    )
+
+    app.home_timeline = (
+        HomeTimelineStore(
+            app.config.get("HOME_TIMELINE_MAX_LENGTH", 800),
+            app.config.get("HOME_TIMELINE_MAX_USERS", 100000),
+            app.config.get("HOME_TIMELINE_TTL", 60),
+            app.config.get("HOME_TIMELINE_MAX_CELEBRITIES", 10000),
+        )
+        if app.config.get("HOME_TIMELINE_ENABLED")
+        else None
+    )
+
+    app.social_graph = (
+        SocialGraph(
+            app.repository,
+            app.config.get("SOCIAL_GRAPH_MAX_USERS", 100000),
+            app.config.get("SOCIAL_GRAPH_TTL", 300),
+        )
+        if app.config.get("SOCIAL_GRAPH_ENABLED")
+        else None
+    )
+
+    app.tweet_queue = None
+    if app.config.get("TWEET_QUEUE_ENABLED"):
+
+        def on_commit(user_ids):
+            with app.app_context():
+                queued_tweets_stored(user_ids)
+
+        app.tweet_queue = TweetQueue(
+            app.config["TWEET_QUEUE_DIR"],
+            app.config.get("TWEET_QUEUE_NAME", "tweets"),
+            app.repository,
+            batch_size=app.config.get("TWEET_QUEUE_BATCH_SIZE", 500),
+            max_delay=app.config.get("TWEET_QUEUE_MAX_DELAY", 0.05),
+            segment_bytes=app.config.get("TWEET_QUEUE_SEGMENT_BYTES", 64 * 1024 * 1024),
+            fsync=app.config.get("TWEET_QUEUE_FSYNC", True),
+            on_commit=on_commit,
+            max_retries=app.config.get("TWEET_QUEUE_MAX_RETRIES", 5),
+        )
+
+        # started by the first request, so gunicorn workers start it after
+        # the fork
+        @app.before_request
+        def start_tweet_queue():
+            app.tweet_queue.ensure_started()
+
+    if app.config.get("DB_REPLICA_URLS"):
+        app.after_request(set_read_primary_cookie)
+
+    if app.config.get("COMPRESSION_ENABLED"):
+        app.after_request(compress_response)
 
     @app.route("/ping", methods=["GET"])
     def ping():
         return "pong"
 
+    @app.route("/internal/stats", methods=["GET"])
+    def internal_stats():
+        return jsonify(
+            {
+                "db_pool": {
+                    label: pool_stats(engine, telemetry)
+                    for label, (engine, telemetry) in app.db_pools.items()
+                }
+                if database is not None
+                else None,
+                "token_cache": app.token_cache.stats(),
+                "user_cache": app.user_cache.stats(),
+                "password_hasher": app.password_hasher.stats(),
+                "social_graph": app.social_graph.stats()
+                if app.social_graph is not None
+                else None,
+                "tweet_queue": app.tweet_queue.stats()
+                if app.tweet_queue is not None
+                else None,
+            }
+        )
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        lines = [
+            *app.request_telemetry.prometheus_lines(),
+            *prometheus_histogram(
+                "miniter_bcrypt_seconds",
+                "bcrypt hash and check latency, queueing included.",
+                app.password_hasher.latency.label_names,
+                app.password_hasher.latency.snapshots(),
+            ),
+            *prometheus_counter(
+                "miniter_bcrypt_rejected_total",
+                "bcrypt requests refused with a full queue.",
+                app.password_hasher.stats()["rejected"],
+            ),
+            *prometheus_counter(
+                "miniter_bcrypt_timeouts_total",
+                "bcrypt requests answered 503 after PASSWORD_HASH_TIMEOUT.",
+                app.password_hasher.stats()["timeouts"],
+            ),
+        ]
+        if database is not None:
+            lines += [
+                *prometheus_histogram(
+                    "miniter_db_pool_checkout_seconds",
+                    "Wait for a pooled database connection, by pool.",
+                    ("pool",),
+                    {
+                        (label,): telemetry.checkout_wait.snapshot()
+                        for label, (_, telemetry) in app.db_pools.items()
+                    },
+                ),
+                *prometheus_histogram(
+                    "miniter_db_pool_held_seconds",
+                    "Time a pooled database connection stays checked out, by pool.",
+                    ("pool",),
+                    {
+                        (label,): telemetry.held.snapshot()
+                        for label, (_, telemetry) in app.db_pools.items()
+                    },
+                ),
+                *prometheus_counter_family(
+                    "miniter_db_pool_timeouts_total",
+                    "Connection checkouts that timed out, by pool.",
+                    ("pool",),
+                    {
+                        (label,): telemetry.timeouts
+                        for label, (_, telemetry) in app.db_pools.items()
+                    },
+                ),
+            ]
+
+        if app.tweet_queue is not None:
+            queue = app.tweet_queue.stats()
+            lines += [
+                *prometheus_gauge(
+                    "miniter_tweet_queue_depth",
+                    "Tweets accepted but not stored yet.",
+                    queue["depth"],
+                ),
+                *prometheus_gauge(
+                    "miniter_tweet_queue_lag_seconds",
+                    "Age of the oldest tweet not stored yet.",
+                    queue["lag_seconds"],
+                ),
+                *prometheus_counter(
+                    "miniter_tweet_queue_failures_total",
+                    "Queue batches that failed to commit (and were retried).",
+                    queue["failures"],
+                ),
+                *prometheus_counter(
+                    "miniter_tweet_queue_dead_lettered_total",
+                    "Queued tweets the database rejected for good (dead-letter file).",
+                    queue["dead_lettered"],
+                ),
+                *prometheus_histogram(
+                    "miniter_tweet_queue_commit_lag_seconds",
+                    "Time from 202 to commit of queued tweets.",
+                    (),
+                    {(): app.tweet_queue.commit_lag.snapshot()},
+                ),
+                *prometheus_histogram(
+                    "miniter_tweet_queue_batch_size",
+                    "Tweets per group commit.",
+                    (),
+                    {(): app.tweet_queue.batch_sizes.snapshot()},
+                ),
+            ]
+
+        return Response(
+            "\n".join(lines) + "\n",
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
     @app.route("/sign-up", methods=["POST"])
     def sign_up():
         new_user = request.json
-        new_user["password"] = bcrypt.hashpw(
-            new_user["password"].encode("UTF-8"), bcrypt.gensalt()
-        )
+        try:
+            new_user["password"] = app.password_hasher.hash(
+                new_user["password"].encode("UTF-8")
+            ).decode("UTF-8")
+        except PasswordHasherBusy:
+            return busy_response()
         new_user_id = insert_user(new_user)
         new_user = get_user(new_user_id)
 
@@ -228,37 +1189,26 @@ def create_app(test_config=None):
         email = credential["email"]
         password = credential["password"]
 
-        print(f"#### email : {email}")
-        print(f"#### password : {password}")
-
-        row = database.execute(
-            text(
-                """
-            SELECT
-                id,
-                hashed_password
-            FROM users
-            WHERE email = :email
-        """
-            ),
-            {"email": email},
-        ).fetchone()
+        row = app.repository.get_credential(email)
 
-        print(f"**** row['hashed_password'] : {row['hashed_password']}")
+        try:
+            authenticated = row and app.password_hasher.check(
+                password.encode("UTF-8"), row["hashed_password"].encode("UTF-8")
+            )
+        except PasswordHasherBusy:
+            return busy_response()
 
-        if row and bcrypt.checkpw(
-            password.encode("UTF-8"), row["hashed_password"].encode("UTF-8")
-        ):
+        if authenticated:
             user_id = row["id"]
-            payload = {
-                "user_id": user_id,
-                "exp": datetime.utcnow() + timedelta(seconds=60 * 60 * 24),
-            }
-            token = jwt.encode(payload, app.config["JWT_SECRET_KEY"], "HS256")
-            print(f"token: {token} - {type(token)}")
+            token = issue_token(user_id, app)
+            logger.info("event=login user_id=%s", user_id)
 
             return jsonify({"access_token": token, "user_id": user_id})
         else:
+            logger.info(
+                "event=login_failed reason=%s",
+                "bad_password" if row else "unknown_email",
+            )
             return "", 401
 
     @app.route("/tweet", methods=["POST"])
@@ -271,14 +1221,48 @@ def create_app(test_config=None):
         if len(tweet) > 300:
             return "exceed 300 chracters", 400
 
+        # workers not owning the queue's log store synchronously
+        if app.tweet_queue is not None and app.tweet_queue.started():
+            return jsonify({"id": app.tweet_queue.enqueue(g.user_id, tweet)}), 202
+
         insert_tweet(user_tweet)
 
         return "", 200
 
+    @app.route("/tweets:batch", methods=["POST"])
+    @login_required
+    def tweet_batch():
+        # a bare array of tweets, or {"tweets": [...]}
+        payload = request.json
+        tweets = payload.get("tweets") if isinstance(payload, dict) else payload
+        if not isinstance(tweets, list):
+            return "tweets must be a list", 400
+        if len(tweets) > app.config.get("TWEET_BATCH_MAX_SIZE", 1000):
+            return "too many tweets", 400
+
+        results = []
+        valid_tweets = []
+        for index, item in enumerate(tweets):
+            tweet = item.get("tweet") if isinstance(item, dict) else None
+            if not isinstance(tweet, str):
+                results.append({"index": index, "status": 400, "error": "no tweet"})
+            elif len(tweet) > 300:
+                results.append(
+                    {"index": index, "status": 400, "error": "exceed 300 chracters"}
+                )
+            else:
+                results.append({"index": index, "status": 200})
+                valid_tweets.append(tweet)
+
+        inserted = insert_tweets(g.user_id, valid_tweets) if valid_tweets else 0
+
+        return jsonify({"inserted": inserted, "results": results})
+
     @app.route("/follow", methods=["POST"])
     @login_required
     def follow():
         payload = request.json
+        payload["id"] = g.user_id
         insert_follow(payload)
 
         return "", 200
@@ -287,19 +1271,94 @@ def create_app(test_config=None):
     @login_required
     def unfollow():
         payload = request.json
+        payload["id"] = g.user_id
         insert_unfollow(payload)
 
         return "", 200
 
+    @app.route("/follow:batch", methods=["POST"])
+    @login_required
+    def follow_batch():
+        try:
+            follow_user_ids = user_id_list(request.json, "follow")
+        except ValueError as e:
+            return str(e), 400
+
+        changed = insert_follows(g.user_id, follow_user_ids) if follow_user_ids else 0
+
+        return jsonify({"changed": changed})
+
+    @app.route("/unfollow:batch", methods=["POST"])
+    @login_required
+    def unfollow_batch():
+        try:
+            unfollow_user_ids = user_id_list(request.json, "unfollow")
+        except ValueError as e:
+            return str(e), 400
+
+        changed = (
+            insert_unfollows(g.user_id, unfollow_user_ids) if unfollow_user_ids else 0
+        )
+
+        return jsonify({"changed": changed})
+
+    @app.route("/users/<int:user_id>/following", methods=["GET"])
+    def following(user_id):
+        return follow_list_response(user_id, "following")
+
+    @app.route("/users/<int:user_id>/followers", methods=["GET"])
+    def followers(user_id):
+        return follow_list_response(user_id, "followers")
+
+    @app.route("/search", methods=["GET"])
+    def search():
+        try:
+            terms, limit, after = search_page_args()
+        except ValueError as e:
+            return str(e), 400
+
+        results, next_cursor = search_tweets(terms, limit, after)
+
+        return jsonify({"query": terms, "results": results, "next_cursor": next_cursor})
+
     @app.route("/timeline/<int:user_id>", methods=["GET"])
     def timeline(user_id):
-        return jsonify({"user_id": user_id, "timeline": get_timeline(user_id)})
+        if wants_stream():
+            return timeline_stream_response(user_id)
+        return timeline_response(user_id)
 
     @app.route("/timeline", methods=["GET"])
     @login_required
     def user_timeline():
-        user_id = g.user_id
+        if wants_stream():
+            return timeline_stream_response(g.user_id)
+        return timeline_response(g.user_id)
 
-        return jsonify({"user_id": user_id, "timeline": get_timeline(user_id)})
+    @app.cli.command("backfill-search")
+    @click.option("--batch-size", default=1000, show_default=True)
+    def backfill_search(batch_size):
+        """
+        index the tweets stored before the search index existed
+
+        walks every tweet table by id, batch_size tweets per transaction;
+        postings already there are skipped, so it can be rerun or resumed.
+        """
+        if app.database is None:
+            click.echo("the memory backend indexes every tweet it stores")
+            return
+
+        repositories = (
+            app.repository.shards
+            if isinstance(app.repository, ShardedRepository)
+            else [app.repository]
+        )
+        for repository in dict.fromkeys(repositories):
+            after = 0
+            while True:
+                last_id = repository.index_tweets_after(after, batch_size)
+                if last_id is None:
+                    break
+                after = last_id
+            click.echo(f"{repository.database.url!r}: indexed up to tweet {after}")
 
     return app
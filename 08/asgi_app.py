@@ -0,0 +1,279 @@
+"""
+---- asgi_app.py
+
+async serving mode of the miniter API
+
+    hypercorn "asgi_app:create_asgi_app()" --bind 0.0.0.0:5000
+
+the routes of app.create_app on Quart, with queries on an async SQLAlchemy
+engine (aiomysql / aiosqlite) and bcrypt on the password process pool, so a
+request that waits on the database or on bcrypt holds no thread.
+"""
+
+import os
+from functools import wraps
+from quart import Quart, Response, g, jsonify, request
+from sqlalchemy.engine import make_url
+
+from app import issue_token, page_of, timeline_page_args, verify_token
+from cache import LRUCache
+from password import PasswordHasher, PasswordHasherBusy
+from queries import build_queries
+from search import postings_rows
+from storage import create_async_database
+
+
+class AsyncSqlRepository:
+    """
+    The SqlRepository queries used by the async routes, on an async engine
+    """
+
+    def __init__(self, database, queries):
+        self.database = database
+        self.queries = queries
+
+    async def fetchone(self, name, params):
+        async with self.database.connect() as connection:
+            result = await connection.execute(self.queries[name], params)
+            return result.mappings().first()
+
+    async def fetchall(self, name, params):
+        async with self.database.connect() as connection:
+            result = await connection.execute(self.queries[name], params)
+            return result.mappings().all()
+
+    async def write(self, name, params):
+        """
+        run a write in its own transaction; returns (lastrowid, rowcount)
+        """
+        async with self.database.begin() as connection:
+            result = await connection.execute(self.queries[name], params)
+            return result.lastrowid, result.rowcount
+
+    async def get_user(self, user_id):
+        return await self.fetchone("get_user", {"user_id": user_id})
+
+    async def get_credential(self, email):
+        return await self.fetchone("get_credential", {"email": email})
+
+    async def insert_user(self, user):
+        user_id, _ = await self.write("insert_user", user)
+        return user_id
+
+    async def insert_tweet(self, user_id, tweet):
+        async with self.database.begin() as connection:
+            result = await connection.execute(
+                self.queries["insert_tweet"], {"id": user_id, "tweet": tweet}
+            )
+            postings = postings_rows([(result.lastrowid, tweet)])
+            if postings:
+                await connection.execute(self.queries["insert_tweet_terms"], postings)
+
+            return result.lastrowid
+
+    async def insert_follow(self, user_id, follow_user_id):
+        _, rowcount = await self.write(
+            "insert_follow", {"id": user_id, "follow": follow_user_id}
+        )
+        return rowcount
+
+    async def delete_follow(self, user_id, unfollow_user_id):
+        _, rowcount = await self.write(
+            "insert_unfollow", {"id": user_id, "unfollow": unfollow_user_id}
+        )
+        return rowcount
+
+    async def get_followee_ids(self, user_id):
+        rows = await self.fetchall("get_followee_ids", {"user_id": user_id})
+        return [row["follow_user_id"] for row in rows]
+
+    async def get_timeline(self, user_ids, limit, before=None):
+        params = {"user_ids": user_ids, "limit": limit}
+        if before is not None:
+            params["before_created_at"], params["before_id"] = before
+
+        return await self.fetchall(
+            "timeline" if before is None else "timeline_before", params
+        )
+
+
+def login_required(f):
+    """
+    login decorate function (async)
+    """
+
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        access_token = request.headers.get("Authorization")
+        payload = verify_token(access_token, g.app) if access_token else None
+        if payload is None or "user_id" not in payload:
+            return Response("", status=401)
+
+        g.user_id = payload["user_id"]
+
+        return await f(*args, **kwargs)
+
+    return decorated_function
+
+
+def busy_response():
+    """
+    503 for a full password hashing queue
+    """
+    return Response("", status=503, headers={"Retry-After": "1"})
+
+
+def create_asgi_app(test_config=None):
+    """
+    create async app function
+    """
+    app = Quart(__name__)
+
+    if test_config is None:
+        app.config.from_pyfile("config.py")
+    else:
+        app.config.update(test_config)
+
+    app.jwt_key = app.config["JWT_SECRET_KEY"].encode("UTF-8")
+    app.token_cache = LRUCache(
+        app.config.get("TOKEN_CACHE_SIZE", 4096),
+        app.config.get("TOKEN_CACHE_TTL", 60),
+    )
+    app.user_cache = LRUCache(
+        app.config.get("USER_CACHE_SIZE", 1024), app.config.get("USER_CACHE_TTL", 60)
+    )
+    app.password_hasher = PasswordHasher(
+        app.config.get("PASSWORD_HASH_WORKERS") or os.cpu_count(),
+        app.config.get("PASSWORD_HASH_QUEUE_SIZE", 64),
+        app.config.get("BCRYPT_ROUNDS", 12),
+        app.config.get("PASSWORD_HASH_TIMEOUT"),
+    )
+
+    @app.before_serving
+    async def connect_database():
+        url = make_url(app.config.get("ASYNC_DB_URL") or app.config["DB_URL"])
+        app.database = await create_async_database(app.config)
+        app.repository = AsyncSqlRepository(
+            app.database, build_queries(url.get_backend_name())
+        )
+
+    @app.after_serving
+    async def dispose_database():
+        await app.database.dispose()
+
+    @app.before_request
+    async def bind_app():
+        g.app = app
+
+    @app.after_request
+    async def allow_cors(response):
+        response.headers["Access-Control-Allow-Origin"] = "*"
+        response.headers["Access-Control-Allow-Headers"] = "Authorization, Content-Type"
+        return response
+
+    async def get_user(user_id):
+        user = app.user_cache.get(user_id)
+        if user is None:
+            row = await app.repository.get_user(user_id)
+            if row is None:
+                return None
+            user = {key: row[key] for key in ("id", "name", "email", "profile")}
+            app.user_cache.set(user_id, user)
+
+        return dict(user)
+
+    async def timeline_response(user_id):
+        try:
+            limit, before = timeline_page_args(request.args, app.config)
+        except ValueError as e:
+            return str(e), 400
+
+        user_ids = sorted({user_id, *await app.repository.get_followee_ids(user_id)})
+        timeline, next_cursor = page_of(
+            await app.repository.get_timeline(user_ids, limit + 1, before), limit
+        )
+
+        return jsonify(
+            {"user_id": user_id, "timeline": timeline, "next_cursor": next_cursor}
+        )
+
+    @app.route("/ping", methods=["GET"])
+    async def ping():
+        return "pong"
+
+    @app.route("/sign-up", methods=["POST"])
+    async def sign_up():
+        new_user = await request.get_json()
+        try:
+            new_user["password"] = (
+                await app.password_hasher.hash_async(
+                    new_user["password"].encode("UTF-8")
+                )
+            ).decode("UTF-8")
+        except PasswordHasherBusy:
+            return busy_response()
+        new_user_id = await app.repository.insert_user(new_user)
+        app.user_cache.invalidate(new_user_id)
+
+        return jsonify(await get_user(new_user_id))
+
+    @app.route("/login", methods=["POST"])
+    async def login():
+        credential = await request.get_json()
+        row = await app.repository.get_credential(credential["email"])
+
+        try:
+            authenticated = row and await app.password_hasher.check_async(
+                credential["password"].encode("UTF-8"),
+                row["hashed_password"].encode("UTF-8"),
+            )
+        except PasswordHasherBusy:
+            return busy_response()
+
+        if authenticated:
+            user_id = row["id"]
+            token = issue_token(user_id, app)
+
+            return jsonify({"access_token": token, "user_id": user_id})
+        else:
+            return "", 401
+
+    @app.route("/tweet", methods=["POST"])
+    @login_required
+    async def tweet():
+        user_tweet = await request.get_json()
+        tweet = user_tweet["tweet"]
+
+        if len(tweet) > 300:
+            return "exceed 300 chracters", 400
+
+        await app.repository.insert_tweet(g.user_id, tweet)
+
+        return "", 200
+
+    @app.route("/follow", methods=["POST"])
+    @login_required
+    async def follow():
+        payload = await request.get_json()
+        await app.repository.insert_follow(g.user_id, payload["follow"])
+
+        return "", 200
+
+    @app.route("/unfollow", methods=["POST"])
+    @login_required
+    async def unfollow():
+        payload = await request.get_json()
+        await app.repository.delete_follow(g.user_id, payload["unfollow"])
+
+        return "", 200
+
+    @app.route("/timeline/<int:user_id>", methods=["GET"])
+    async def timeline(user_id):
+        return await timeline_response(user_id)
+
+    @app.route("/timeline", methods=["GET"])
+    @login_required
+    async def user_timeline():
+        return await timeline_response(g.user_id)
+
+    return app
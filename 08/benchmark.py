@@ -0,0 +1,265 @@
+"""
+---- benchmark.py
+
+load test of the miniter API against the test database
+(sqlite by default, MINITER_TEST_DB_URL=mysql for miniter_test)
+
+seeds a synthetic social graph, then drives /login, /tweet, /follow and
+/timeline through create_app(config.test_config) at a fixed concurrency and
+prints p50/p95/p99 latency and throughput per endpoint as JSON.
+"""
+
+import argparse
+import json
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import bcrypt
+from sqlalchemy import text
+
+import config
+from app import create_app
+from db_pool import PoolTelemetry
+from storage import create_database, truncate_tables
+
+PASSWORD = "1111"
+
+
+def parse_args(argv):
+    """
+    command line options
+    """
+    parser = argparse.ArgumentParser(description="miniter API load test")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument(
+        "--follow-alpha",
+        type=float,
+        default=1.5,
+        help="pareto shape of the per-user followee count",
+    )
+    parser.add_argument("--max-follows", type=int, default=500)
+    parser.add_argument("--tweets-per-user", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--requests", type=int, default=1000, help="requests per endpoint"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here as well")
+
+    return parser.parse_args(argv)
+
+
+def follow_graph(rng, users, alpha, max_follows):
+    """
+    (user_id, follow_user_id) pairs with a heavy-tailed followee count and
+    preferential (zipf-like) choice of whom to follow
+    """
+    user_ids = list(range(1, users + 1))
+    weights = [1.0 / rank for rank in user_ids]
+
+    for user_id in user_ids:
+        count = min(int(rng.paretovariate(alpha)), max_follows, users - 1)
+        followees = set()
+        while len(followees) < count:
+            followee = rng.choices(user_ids, weights)[0]
+            if followee != user_id:
+                followees.add(followee)
+
+        for followee in sorted(followees):
+            yield user_id, followee
+
+
+def seed(database, args):
+    """
+    reset and seed the benchmark database
+    """
+    rng = random.Random(args.seed)
+    hashed_password = bcrypt.hashpw(
+        PASSWORD.encode("UTF-8"),
+        bcrypt.gensalt(config.test_config.get("BCRYPT_ROUNDS", 12)),
+    ).decode("UTF-8")
+
+    truncate_tables(database)
+
+    database.execute(
+        text(
+            """
+        INSERT INTO users (
+            id,
+            name,
+            email,
+            profile,
+            hashed_password
+        ) VALUES (
+            :id,
+            :name,
+            :email,
+            :profile,
+            :hashed_password
+        )
+    """
+        ),
+        [
+            {
+                "id": user_id,
+                "name": f"user{user_id}",
+                "email": f"user{user_id}@bench.test",
+                "profile": "bench",
+                "hashed_password": hashed_password,
+            }
+            for user_id in range(1, args.users + 1)
+        ],
+    )
+    database.execute(
+        text(
+            """
+        INSERT INTO users_follow_list (
+            user_id,
+            follow_user_id
+        ) VALUES (
+            :user_id,
+            :follow_user_id
+        )
+    """
+        ),
+        [
+            {"user_id": user_id, "follow_user_id": follow_user_id}
+            for user_id, follow_user_id in follow_graph(
+                rng, args.users, args.follow_alpha, args.max_follows
+            )
+        ],
+    )
+    for user_id in range(1, args.users + 1):
+        database.execute(
+            text(
+                """
+            INSERT INTO tweets (
+                user_id,
+                tweet
+            ) VALUES (
+                :user_id,
+                :tweet
+            )
+        """
+            ),
+            [
+                {"user_id": user_id, "tweet": f"tweet {i} of user {user_id}"}
+                for i in range(args.tweets_per_user)
+            ],
+        )
+
+
+def percentile(latencies, q):
+    """
+    nearest-rank percentile of sorted latencies
+    """
+    if not latencies:
+        return None
+
+    rank = max(int(round(q / 100 * len(latencies))) - 1, 0)
+    return latencies[min(rank, len(latencies) - 1)]
+
+
+def run_endpoint(app, concurrency, count, request_fn):
+    """
+    fire count requests with concurrency threads and time each one
+    """
+
+    def worker(indexes):
+        client = app.test_client()
+        results = []
+        for index in indexes:
+            started_at = perf_counter()
+            status = request_fn(client, index)
+            results.append((perf_counter() - started_at, status))
+        return results
+
+    chunks = [range(i, count, concurrency) for i in range(concurrency)]
+    started_at = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = [r for chunk in executor.map(worker, chunks) for r in chunk]
+    elapsed = perf_counter() - started_at
+
+    latencies = sorted(latency for latency, _ in results)
+    to_ms = lambda seconds: None if seconds is None else round(seconds * 1000, 3)
+
+    return {
+        "requests": len(results),
+        "errors": sum(1 for _, status in results if status >= 400),
+        "throughput_rps": round(len(results) / elapsed, 2) if elapsed else None,
+        "mean_ms": to_ms(sum(latencies) / len(latencies)) if latencies else None,
+        "p50_ms": to_ms(percentile(latencies, 50)),
+        "p95_ms": to_ms(percentile(latencies, 95)),
+        "p99_ms": to_ms(percentile(latencies, 99)),
+    }
+
+
+def login(client, user_id):
+    """
+    log user_id in and return the response
+    """
+    return client.post(
+        "/login",
+        data=json.dumps({"email": f"user{user_id}@bench.test", "password": PASSWORD}),
+        content_type="application/json",
+    )
+
+
+def main(argv=None):
+    """
+    seed, run and report
+    """
+    args = parse_args(argv)
+    rng = random.Random(args.seed + 1)
+
+    database = create_database(config.test_config, PoolTelemetry())
+    seed(database, args)
+
+    app = create_app(config.test_config)
+    client = app.test_client()
+    tokens = {
+        user_id: json.loads(login(client, user_id).data)["access_token"]
+        for user_id in range(1, min(args.users, args.concurrency * 4) + 1)
+    }
+    token_ids = list(tokens)
+    pick = lambda index: token_ids[index % len(token_ids)]
+
+    endpoints = {
+        "login": lambda client, i: login(client, pick(i)).status_code,
+        "tweet": lambda client, i: client.post(
+            "/tweet",
+            data=json.dumps({"tweet": f"bench tweet {i}"}),
+            content_type="application/json",
+            headers={"Authorization": tokens[pick(i)]},
+        ).status_code,
+        "follow": lambda client, i: client.post(
+            "/follow",
+            data=json.dumps({"follow": rng.randint(1, args.users)}),
+            content_type="application/json",
+            headers={"Authorization": tokens[pick(i)]},
+        ).status_code,
+        "timeline": lambda client, i: client.get(
+            "/timeline", headers={"Authorization": tokens[pick(i)]}
+        ).status_code,
+    }
+
+    report = {
+        "config": vars(args),
+        "endpoints": {
+            name: run_endpoint(app, args.concurrency, args.requests, request_fn)
+            for name, request_fn in endpoints.items()
+        },
+    }
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+    return report
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,141 @@
+"""
+---- compression.py
+
+response compression negotiated from Accept-Encoding: gzip always, brotli
+and zstd when their packages (brotli, zstandard) are installed.
+"""
+
+import zlib
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_MIMETYPES = {
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "text/css",
+    "text/html",
+    "text/plain",
+}
+
+
+def gzip_encoder(level):
+    """
+    (compress, flush, finish) of a gzip stream
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    return (
+        compressor.compress,
+        lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+        compressor.flush,
+    )
+
+
+def brotli_encoder(level):
+    """
+    (compress, flush, finish) of a brotli stream
+    """
+    compressor = brotli.Compressor(quality=level)
+
+    return compressor.process, compressor.flush, compressor.finish
+
+
+def zstd_encoder(level):
+    """
+    (compress, flush, finish) of a zstd stream
+    """
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    return (
+        compressor.compress,
+        lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+        compressor.flush,
+    )
+
+
+ENCODERS = {"gzip": gzip_encoder}
+if brotli is not None:
+    ENCODERS["br"] = brotli_encoder
+if zstandard is not None:
+    ENCODERS["zstd"] = zstd_encoder
+
+
+def negotiate_encoding(encodings):
+    """
+    the first of encodings (in server preference order) that the client
+    accepts with the highest quality, or None
+    """
+    available = [encoding for encoding in encodings if encoding in ENCODERS]
+    if not available:
+        return None
+
+    return request.accept_encodings.best_match(available)
+
+
+def compressed_chunks(chunks, encoder):
+    """
+    compress a streamed body, flushing after every chunk so each one
+    reaches the client as soon as it is written
+    """
+    compress, flush, finish = encoder
+    for chunk in chunks:
+        data = compress(chunk) + flush()
+        if data:
+            yield data
+
+    yield finish()
+
+
+def compress_response(response):
+    """
+    after_request hook compressing compressible responses
+    """
+    config = current_app.config
+    if (
+        response.status_code < 200
+        or response.status_code in (204, 304)
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+
+    encoding = negotiate_encoding(
+        config.get("COMPRESSION_ENCODINGS", ("br", "zstd", "gzip"))
+    )
+    if encoding is None:
+        return response
+
+    level = config.get("COMPRESSION_LEVELS", {}).get(encoding, 6)
+
+    if response.is_streamed:
+        body = response.response
+        if hasattr(body, "close"):
+            response.call_on_close(body.close)
+        response.response = compressed_chunks(
+            response.iter_encoded(), ENCODERS[encoding](level)
+        )
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < config.get("COMPRESSION_MIN_SIZE", 1024):
+            return response
+
+        compress, _, finish = ENCODERS[encoding](level)
+        response.set_data(compress(data) + finish())
+
+    response.headers["Content-Encoding"] = encoding
+
+    return response
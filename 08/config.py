@@ -2,6 +2,9 @@
 # config.py for DB conn info (db, test_b) and secret key
 """
 
+import os
+import tempfile
+
 db = {
     "user": "root",
     "password": "1111",
@@ -22,11 +25,139 @@ test_db = {
     "port": 3306,
     "database": "miniter_test",
 }
-test_config = {
-    "DB_URL": f"mysql+mysqlconnector://{test_db['user']}:"
+TEST_MYSQL_DB_URL = (
+    f"mysql+mysqlconnector://{test_db['user']}:"
     + f"{test_db['password']}@{test_db['host']}:"
-    + f"{test_db['port']}/{test_db['database']}?charset=utf8",
+    + f"{test_db['port']}/{test_db['database']}?charset=utf8"
+)
+# tests run on a throwaway sqlite file unless MINITER_TEST_DB_URL says otherwise
+# (e.g. MINITER_TEST_DB_URL=mysql to use the miniter_test database above)
+TEST_SQLITE_DB_URL = (
+    f"sqlite:///{os.path.join(tempfile.gettempdir(), 'miniter_test.db')}"
+)
+TEST_DB_URL = os.environ.get("MINITER_TEST_DB_URL", TEST_SQLITE_DB_URL)
+if TEST_DB_URL == "mysql":
+    TEST_DB_URL = TEST_MYSQL_DB_URL
+
+test_config = {
+    "DB_URL": TEST_DB_URL,
     "JWT_SECRET_KEY": "SOME_SUPER_SECRET_KEY",
+    "TIMELINE_PAGE_SIZE": 50,
+    "TIMELINE_MAX_PAGE_SIZE": 200,
+    "PASSWORD_HASH_WORKERS": 1,
+    "BCRYPT_ROUNDS": 4,
 }
 
 JWT_SECRET_KEY = "SOME_SUPER_SECRET_KEY"
+
+# miniter logger level and logfmt line format
+LOG_LEVEL = "INFO"
+LOG_FORMAT = "time=%(asctime)s level=%(levelname)s %(message)s"
+
+# "sql" (DB_URL, mysql or sqlite) or "memory" (in-process, nothing persisted)
+STORAGE_BACKEND = "sql"
+
+# async serving mode (asgi_app.py); empty means DB_URL on its async driver
+ASYNC_DB_URL = None
+
+# read replicas of DB_URL (reads go round-robin to them; a user's reads stay
+# on the primary for READ_YOUR_WRITES_SECONDS after their own write, on any
+# worker, through a cookie the write response sets)
+DB_REPLICA_URLS = []
+READ_YOUR_WRITES_SECONDS = 5
+
+# tweets hash-partitioned by user_id over TWEET_SHARD_COUNT shards (default:
+# one per url), shard i in TWEET_SHARD_URLS[i % len(TWEET_SHARD_URLS)]; the
+# shard databases get database_setting/sql/create_shard_table.sql. no urls
+# keeps the tweets in DB_URL
+TWEET_SHARD_URLS = []
+TWEET_SHARD_COUNT = None
+
+# connection pool (size it against gunicorn workers x threads;
+# recycle below the MySQL wait_timeout)
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 0
+DB_POOL_TIMEOUT = 30
+DB_POOL_RECYCLE = 3600
+DB_POOL_PRE_PING = True
+# compiled statement cache entries per engine
+DB_QUERY_CACHE_SIZE = 500
+
+# timeline pagination (limit default and upper bound)
+TIMELINE_PAGE_SIZE = 50
+TIMELINE_MAX_PAGE_SIZE = 200
+# rows fetched (and written) per chunk of a streamed (NDJSON) timeline
+TIMELINE_STREAM_BATCH_SIZE = 500
+
+# response compression (encodings in preference order; br and zstd need the
+# brotli and zstandard packages; smaller bodies are sent as they are)
+COMPRESSION_ENABLED = True
+COMPRESSION_ENCODINGS = ("br", "zstd", "gzip")
+COMPRESSION_LEVELS = {"br": 4, "zstd": 3, "gzip": 6}
+COMPRESSION_MIN_SIZE = 1024
+
+# fan-out-on-write home timelines (authors with at least
+# CELEBRITY_FOLLOWER_THRESHOLD followers are merged in at read time); not
+# with TWEET_SHARD_URLS, whose tweet ids do not follow time across shards
+HOME_TIMELINE_ENABLED = False
+HOME_TIMELINE_MAX_LENGTH = 800
+# timelines are per process, so they expire after HOME_TIMELINE_TTL seconds
+# (bounds how long other workers' tweets stay missing; 0 never expires them);
+# LRU bounded, like the celebrity marks
+HOME_TIMELINE_MAX_USERS = 100000
+HOME_TIMELINE_TTL = 60
+HOME_TIMELINE_MAX_CELEBRITIES = 10000
+CELEBRITY_FOLLOWER_THRESHOLD = 10000
+
+# followee / follower id arrays cached per user (SocialGraph), opt-in: the
+# cache is per process, so another worker's follows stay unseen (and its
+# timelines stale) for up to the ttl; enable it for single-process serving
+SOCIAL_GRAPH_ENABLED = False
+SOCIAL_GRAPH_MAX_USERS = 100000
+SOCIAL_GRAPH_TTL = 300
+
+# /users/<id>/following and /followers pages
+FOLLOW_PAGE_SIZE = 100
+FOLLOW_MAX_PAGE_SIZE = 1000
+
+# write-behind tweets: POST /tweet appends to a local log and answers 202, a
+# writer thread stores the log in batches; one process owns TWEET_QUEUE_DIR,
+# other workers sharing it store their tweets synchronously
+TWEET_QUEUE_ENABLED = False
+TWEET_QUEUE_DIR = os.path.join(os.path.dirname(__file__), "tweet_queue")
+TWEET_QUEUE_NAME = "tweets"
+TWEET_QUEUE_BATCH_SIZE = 500
+TWEET_QUEUE_MAX_DELAY = 0.05
+TWEET_QUEUE_SEGMENT_BYTES = 64 * 1024 * 1024
+TWEET_QUEUE_FSYNC = True
+# failed commits of a batch before it is stored tweet by tweet; a tweet the
+# database keeps rejecting then goes to TWEET_QUEUE_DIR/<name>.dead.jsonl
+TWEET_QUEUE_MAX_RETRIES = 5
+
+# GET /search pages (limit default and upper bound), terms used per query and
+# newest postings ranked per term (bounds the work of a query)
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+SEARCH_MAX_TERMS = 8
+SEARCH_MAX_POSTINGS = 1000
+
+# in-process user profile cache (entries, seconds)
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 60
+
+# bcrypt process pool (workers default to the CPU count; a full queue is 503)
+# each gunicorn worker has its own pool, so share the cores out between them
+PASSWORD_HASH_WORKERS = None
+PASSWORD_HASH_QUEUE_SIZE = 64
+PASSWORD_HASH_TIMEOUT = 10
+BCRYPT_ROUNDS = 12
+
+# verified access token cache (entries, seconds; never past the token's exp)
+TOKEN_CACHE_SIZE = 4096
+TOKEN_CACHE_TTL = 60
+
+# POST /tweets:batch upper bound on tweets per request
+TWEET_BATCH_MAX_SIZE = 1000
+
+# POST /follow:batch and /unfollow:batch upper bound on ids per request
+FOLLOW_BATCH_MAX_SIZE = 1000
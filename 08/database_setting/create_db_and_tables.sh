@@ -3,3 +3,7 @@
 mysql -uroot -p1111 -e 'create database miniter'
 mysql -uroot -p1111 -Dminiter < ./sql/create_table.sql
 mysql -uroot -p1111 -Dminiter -e 'show tables;'
+
+# a database with tweets from before the search index (tweet_terms) needs
+# them indexed once:
+#   cd .. && FLASK_APP=app flask backfill-search
@@ -0,0 +1,14 @@
+#!/bin/bash
+
+# usage: ./create_shard_dbs.sh N
+# creates the tweet shard databases miniter_shard_0 .. miniter_shard_{N-1}
+
+for ((i = 0; i < ${1:-2}; i++))
+do
+	mysql -uroot -p1111 -e "create database miniter_shard_$i"
+	mysql -uroot -p1111 -Dminiter_shard_$i < ./sql/create_shard_table.sql
+done
+mysql -uroot -p1111 -e 'show databases;'
+
+# shards with tweets from before the search index need them indexed once:
+#   cd .. && FLASK_APP=app flask backfill-search
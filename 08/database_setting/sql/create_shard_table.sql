@@ -0,0 +1,20 @@
+CREATE TABLE tweets(
+    id INT NOT NULL AUTO_INCREMENT,
+    user_id INT NOT NULL,
+    tweet VARCHAR(300) NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (id),
+    KEY tweets_user_id_created_at_id_idx (user_id, created_at, id)
+);
+
+CREATE TABLE tweet_terms(
+    term VARCHAR(64) NOT NULL,
+    tweet_id INT NOT NULL,
+    PRIMARY KEY (term, tweet_id),
+    CONSTRAINT tweet_terms_tweet_id_fkey FOREIGN KEY (tweet_id) REFERENCES tweets(id)
+);
+
+CREATE TABLE tweet_queue_checkpoints(
+    name VARCHAR(255) NOT NULL,
+    position BIGINT NOT NULL,
+    PRIMARY KEY (name)
+);
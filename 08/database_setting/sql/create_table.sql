@@ -15,6 +15,7 @@ CREATE TABLE users_follow_list(
     follow_user_id INT NOT NULL,
     created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, 
     PRIMARY KEY (user_id, follow_user_id),
+    KEY users_follow_list_follow_user_id_idx (follow_user_id, user_id),
     CONSTRAINT users_follow_list_user_id_fkey FOREIGN KEY (user_id) REFERENCES users(id), 
     CONSTRAINT users_follow_list_follow_user_id_fkey FOREIGN KEY (follow_user_id) REFERENCES users(id)
 );
@@ -24,5 +25,19 @@ CREATE TABLE tweets(
     user_id INT NOT NULL,
     tweet VARCHAR(300) NOT NULL,
     created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (id),
+    KEY tweets_user_id_created_at_id_idx (user_id, created_at, id),
     CONSTRAINT tweets_user_id_fkey FOREIGN KEY (user_id) REFERENCES users(id)
 );
+
+CREATE TABLE tweet_terms(
+    term VARCHAR(64) NOT NULL,
+    tweet_id INT NOT NULL,
+    PRIMARY KEY (term, tweet_id),
+    CONSTRAINT tweet_terms_tweet_id_fkey FOREIGN KEY (tweet_id) REFERENCES tweets(id)
+);
+
+CREATE TABLE tweet_queue_checkpoints(
+    name VARCHAR(255) NOT NULL,
+    position BIGINT NOT NULL,
+    PRIMARY KEY (name)
+);
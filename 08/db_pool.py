@@ -0,0 +1,107 @@
+"""
+---- db_pool.py
+"""
+
+from threading import Lock
+from time import perf_counter
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from metrics import Histogram
+
+
+class PoolTelemetry:
+    """
+    Connection pool checkout counters of one engine
+    """
+
+    def __init__(self):
+        self.checkout_wait = Histogram()
+        self.held = Histogram()
+        self.timeouts = 0
+        self.lock = Lock()
+
+    def timed_out(self):
+        with self.lock:
+            self.timeouts += 1
+
+    def checked_out(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checked_out_at"] = perf_counter()
+
+    def checked_in(self, dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop("checked_out_at", None)
+        if checked_out_at is not None:
+            self.held.observe(perf_counter() - checked_out_at)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool that times every checkout
+
+    the wait is timed around the public connect(); how long a connection
+    is held comes from the checkout and checkin pool events.
+    """
+
+    telemetry = None
+
+    def connect(self):
+        started_at = perf_counter()
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            self.telemetry.timed_out()
+            raise
+        finally:
+            self.telemetry.checkout_wait.observe(perf_counter() - started_at)
+
+
+def instrumented_pool_class(telemetry):
+    """
+    InstrumentedQueuePool bound to telemetry
+
+    the binding (and its event listeners) is on the class so
+    engine.dispose(), which rebuilds the pool from its class, keeps
+    reporting to the same telemetry.
+    """
+    pool_class = type(
+        "InstrumentedQueuePool", (InstrumentedQueuePool,), {"telemetry": telemetry}
+    )
+    event.listen(pool_class, "checkout", telemetry.checked_out)
+    event.listen(pool_class, "checkin", telemetry.checked_in)
+
+    return pool_class
+
+
+def engine_options(config, telemetry):
+    """
+    create_engine pool and statement cache keyword arguments from app config
+    """
+    return {
+        "poolclass": instrumented_pool_class(telemetry),
+        "pool_size": config.get("DB_POOL_SIZE", 5),
+        "max_overflow": config.get("DB_MAX_OVERFLOW", 0),
+        "pool_timeout": config.get("DB_POOL_TIMEOUT", 30),
+        "pool_recycle": config.get("DB_POOL_RECYCLE", 3600),
+        "pool_pre_ping": config.get("DB_POOL_PRE_PING", True),
+        "query_cache_size": config.get("DB_QUERY_CACHE_SIZE", 500),
+    }
+
+
+def pool_stats(engine, telemetry):
+    """
+    pool gauges and checkout telemetry of engine
+    """
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {"pool": type(pool).__name__}
+
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "timeouts": telemetry.timeouts,
+        "checkout_wait_seconds": telemetry.checkout_wait.snapshot(),
+        "held_seconds": telemetry.held.snapshot(),
+    }
@@ -0,0 +1,46 @@
+"""
+---- gunicorn.conf.py
+
+gunicorn settings for wsgi:app (see run_gunicorn.sh)
+
+the app is loaded once in the master and forked into the workers; each
+worker drops the inherited connection pool in post_fork, so pooled
+connections are opened after the fork and never shared between processes.
+the bcrypt process pool is started on first use in each worker for the
+same reason (PasswordHasher.pool).
+"""
+
+import os
+
+import config
+
+bind = os.environ.get("MINITER_BIND", "0.0.0.0:5000")
+
+# one worker process per core, one thread per pooled connection
+# (STORAGE_BACKEND = "memory" keeps data per worker: use MINITER_WORKERS=1)
+workers = int(os.environ.get("MINITER_WORKERS", os.cpu_count() or 1))
+worker_class = "gthread"
+threads = int(os.environ.get("MINITER_THREADS", config.DB_POOL_SIZE))
+
+# import the app (and its modules) once, before forking
+preload_app = True
+
+# recycle workers now and then so slow leaks cannot build up
+max_requests = 10000
+max_requests_jitter = 1000
+
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+
+
+def post_fork(server, worker):
+    """
+    forget the connections opened by the master (close=False leaves them to
+    the master; the worker's pool starts empty)
+    """
+    from wsgi import app
+
+    for database in [app.database, *app.replica_databases, *app.shard_databases]:
+        if database is not None:
+            database.dispose(close=False)
@@ -0,0 +1,92 @@
+"""
+---- home_timeline.py
+"""
+
+from collections import deque
+from threading import Lock
+
+from cache import LRUCache
+
+
+class HomeTimelineStore:
+    """
+    Fan-out-on-write home timeline store
+
+    keeps, per reader, the newest tweet ids (newest first) of the reader and
+    of every followee that is not a celebrity. celebrity tweets are not
+    pushed; they are merged in at read time.
+
+    the store is per process and only sees this process' pushes, so a
+    timeline expires ttl seconds after it was materialized and is rebuilt
+    from the tweets table; that bounds how long another worker's tweets stay
+    missing. timelines and celebrity marks are LRU bounded; a ttl of 0 (or
+    None) never expires them.
+    """
+
+    def __init__(self, max_length, max_users=100000, ttl=60, max_celebrities=10000):
+        ttl = ttl or float("inf")
+        self.max_length = max_length
+        self.timelines = LRUCache(max_users, ttl)
+        self.celebrities = LRUCache(max_celebrities, ttl)
+        self.lock = Lock()
+
+    def get(self, user_id):
+        """
+        tweet ids of user_id's home timeline and whether nothing was cut off,
+        or None when it is not materialized (or expired)
+        """
+        with self.lock:
+            entry = self.timelines.get(user_id)
+            if entry is None:
+                return None
+
+            timeline, complete = entry
+            return list(timeline), complete
+
+    def put(self, user_id, tweet_ids):
+        """
+        materialize user_id's home timeline from newest-first tweet ids;
+        returns it as get() does
+        """
+        timeline = deque(tweet_ids, maxlen=self.max_length)
+        complete = len(tweet_ids) < self.max_length
+        with self.lock:
+            self.timelines.set(user_id, [timeline, complete])
+
+            return list(timeline), complete
+
+    def push(self, user_ids, tweet_id):
+        """
+        push a new tweet id to the materialized home timelines of user_ids
+        """
+        with self.lock:
+            for user_id in user_ids:
+                entry = self.timelines.get(user_id)
+                if entry is None:
+                    continue
+
+                timeline = entry[0]
+                if len(timeline) == self.max_length:
+                    entry[1] = False
+                timeline.appendleft(tweet_id)
+
+    def invalidate(self, user_id):
+        """
+        drop user_id's home timeline so the next read rebuilds it
+        """
+        with self.lock:
+            self.timelines.invalidate(user_id)
+
+    def mark_celebrities(self, user_ids):
+        """
+        mark authors whose tweets are merged at read time (the mark is
+        renewed whenever their follower count is checked again)
+        """
+        for user_id in user_ids:
+            self.celebrities.set(user_id, True)
+
+    def celebrities_in(self, user_ids):
+        """
+        celebrities among user_ids
+        """
+        return {user_id for user_id in user_ids if self.celebrities.get(user_id)}
@@ -0,0 +1,81 @@
+"""
+---- json_provider.py
+
+app.json for jsonify and request.json: orjson when it is installed, the
+standard library json module otherwise. both write sets as lists and
+datetimes as TIMESTAMP_FORMAT text, so responses look the same either way.
+"""
+
+from datetime import date, datetime
+from flask.json.provider import DefaultJSONProvider
+
+from repository import TIMESTAMP_FORMAT
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(obj):
+    """
+    JSON form of the types json and orjson do not write themselves
+    """
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, datetime):
+        return obj.strftime(TIMESTAMP_FORMAT)
+    if isinstance(obj, date):
+        return obj.isoformat()
+
+    return DefaultJSONProvider.default(obj)
+
+
+class MiniterJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider on orjson, with the stdlib provider as fallback
+    """
+
+    default = staticmethod(default)
+
+    def options(self, indent=False):
+        """
+        orjson option flags matching the stdlib provider settings
+        """
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+
+        return option
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+
+        try:
+            return orjson.dumps(obj, default, self.options()).decode("UTF-8")
+        except orjson.JSONEncodeError:
+            return super().dumps(obj)
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        try:
+            body = orjson.dumps(
+                obj, default, self.options(indent) | orjson.OPT_APPEND_NEWLINE
+            )
+        except orjson.JSONEncodeError:
+            return super().response(*args, **kwargs)
+
+        return self._app.response_class(body, mimetype=self.mimetype)
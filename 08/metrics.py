@@ -0,0 +1,157 @@
+"""
+---- metrics.py
+"""
+
+from bisect import bisect_left
+from threading import Lock
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# per-request counts (e.g. SQL statements per request)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    """
+    Fixed bucket histogram (upper bounds in seconds)
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = Lock()
+
+    def observe(self, value):
+        """
+        record one observation
+        """
+        with self.lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """
+        cumulative bucket counts, sum and count
+        """
+        with self.lock:
+            cumulative = []
+            total = 0
+            for count in self.counts[:-1]:
+                total += count
+                cumulative.append(total)
+
+            return {
+                "buckets": dict(zip(self.buckets, cumulative)),
+                "sum": self.sum,
+                "count": self.count,
+            }
+
+
+class LabeledHistogram:
+    """
+    One Histogram per combination of label values
+    """
+
+    def __init__(self, label_names, buckets=LATENCY_BUCKETS):
+        self.label_names = tuple(label_names)
+        self.buckets = buckets
+        self.histograms = {}
+        self.lock = Lock()
+
+    def observe(self, labels, value):
+        """
+        record one observation for the label values in labels (a tuple)
+        """
+        histogram = self.histograms.get(labels)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(labels, Histogram(self.buckets))
+        histogram.observe(value)
+
+    def snapshots(self):
+        """
+        snapshot of every histogram, keyed by label values
+        """
+        with self.lock:
+            histograms = dict(self.histograms)
+
+        return {labels: h.snapshot() for labels, h in sorted(histograms.items())}
+
+
+def prometheus_labels(pairs):
+    """
+    {name="value",...} label set of the Prometheus text format
+    """
+    if not pairs:
+        return ""
+
+    escape = lambda value: (
+        str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    )
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+def prometheus_histogram(name, help_text, label_names, snapshots):
+    """
+    Prometheus text format lines of a histogram family
+
+    snapshots maps label value tuples to Histogram.snapshot() results.
+    """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for labels, snapshot in snapshots.items():
+        pairs = list(zip(label_names, labels))
+        for le, count in snapshot["buckets"].items():
+            lines.append(
+                f"{name}_bucket{prometheus_labels(pairs + [('le', le)])} {count}"
+            )
+        lines.append(
+            f"{name}_bucket{prometheus_labels(pairs + [('le', '+Inf')])} "
+            f"{snapshot['count']}"
+        )
+        lines.append(f"{name}_sum{prometheus_labels(pairs)} {snapshot['sum']}")
+        lines.append(f"{name}_count{prometheus_labels(pairs)} {snapshot['count']}")
+
+    return lines
+
+
+def prometheus_counter(name, help_text, value):
+    """
+    Prometheus text format lines of an unlabeled counter
+    """
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} counter", f"{name} {value}"]
+
+
+def prometheus_counter_family(name, help_text, label_names, values):
+    """
+    Prometheus text format lines of a labeled counter family
+
+    values maps label value tuples to counts.
+    """
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} counter"] + [
+        f"{name}{prometheus_labels(list(zip(label_names, labels)))} {value}"
+        for labels, value in values.items()
+    ]
+
+
+def prometheus_gauge(name, help_text, value):
+    """
+    Prometheus text format lines of an unlabeled gauge
+    """
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
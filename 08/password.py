@@ -0,0 +1,196 @@
+"""
+---- password.py
+"""
+
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+import bcrypt
+
+from metrics import LabeledHistogram
+
+
+class PasswordHasherBusy(Exception):
+    """
+    raised when the hashing queue is full, a hash outlives the timeout or
+    the pool has died
+    """
+
+
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _checkpw(password, hashed_password):
+    return bcrypt.checkpw(password, hashed_password)
+
+
+class PasswordHasher:
+    """
+    bcrypt on a bounded process pool
+
+    keeps request threads free while a hash burns CPU, and refuses new work
+    once workers + max_queue hashes are in flight.
+
+    the pool is started on first use in each process: a pool inherited
+    through fork (gunicorn preload_app) shares its call and result pipes
+    with the parent, so a forked process starts its own.
+    """
+
+    def __init__(self, workers, max_queue, rounds, timeout=None):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.rounds = rounds
+        self.timeout = timeout
+        self.executor = None
+        self.pid = None
+        self.slots = BoundedSemaphore(workers + max_queue)
+        self.lock = Lock()
+        self.in_flight = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.latency = LabeledHistogram(("operation",))
+
+    def hash(self, password):
+        """
+        bcrypt hash of password (bytes)
+        """
+        return self.result(self.submit(_hashpw, password, self.rounds))
+
+    def check(self, password, hashed_password):
+        """
+        bcrypt check of password (bytes) against hashed_password (bytes)
+        """
+        return self.result(self.submit(_checkpw, password, hashed_password))
+
+    async def hash_async(self, password):
+        """
+        hash() for coroutines
+        """
+        return await self.result_async(self.submit(_hashpw, password, self.rounds))
+
+    async def check_async(self, password, hashed_password):
+        """
+        check() for coroutines
+        """
+        return await self.result_async(self.submit(_checkpw, password, hashed_password))
+
+    def result(self, future):
+        """
+        result of future within the timeout; a timeout or a dead pool is
+        PasswordHasherBusy, so a saturated pool fails fast
+        """
+        try:
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            self.timed_out(future)
+            raise PasswordHasherBusy()
+        except BrokenProcessPool:
+            raise PasswordHasherBusy()
+
+    async def result_async(self, future):
+        """
+        result() for coroutines
+        """
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.timed_out(future)
+            raise PasswordHasherBusy()
+        except BrokenProcessPool:
+            raise PasswordHasherBusy()
+
+    def timed_out(self, future):
+        # a hash still queued is dropped; a running one finishes unread
+        future.cancel()
+        with self.lock:
+            self.timeouts += 1
+
+    def submit(self, fn, *args):
+        """
+        run fn on the pool; raises PasswordHasherBusy when the queue is full
+        """
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise PasswordHasherBusy()
+
+        with self.lock:
+            self.in_flight += 1
+        started_at = perf_counter()
+        operation = fn.__name__.lstrip("_")
+
+        def done(future):
+            elapsed = perf_counter() - started_at
+            with self.lock:
+                self.in_flight -= 1
+                self.count += 1
+                self.total_seconds += elapsed
+                self.max_seconds = max(self.max_seconds, elapsed)
+            self.latency.observe((operation,), elapsed)
+            self.slots.release()
+
+        try:
+            future = self.pool_submit(fn, *args)
+        except BaseException as e:
+            with self.lock:
+                self.in_flight -= 1
+            self.slots.release()
+            if isinstance(e, BrokenProcessPool):
+                raise PasswordHasherBusy() from e
+            raise
+        future.add_done_callback(done)
+
+        return future
+
+    def pool(self):
+        """
+        this process' executor, started on first use
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                # the parent's pool is left alone: shutting it down from
+                # here would write to the pipes the parent still uses
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+                self.pid = os.getpid()
+
+            return self.executor
+
+    def pool_submit(self, fn, *args):
+        """
+        executor.submit, replacing a pool broken by a dead worker once
+        """
+        executor = self.pool()
+        try:
+            return executor.submit(fn, *args)
+        except BrokenProcessPool:
+            with self.lock:
+                if self.executor is executor:
+                    self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            executor.shutdown(wait=False)
+
+            return self.executor.submit(fn, *args)
+
+    def stats(self):
+        """
+        queue depth and hash latency counters
+        """
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "in_flight": self.in_flight,
+                "queue_depth": max(self.in_flight - self.workers, 0),
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "count": self.count,
+                "total_seconds": self.total_seconds,
+                "max_seconds": self.max_seconds,
+            }
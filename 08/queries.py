@@ -0,0 +1,287 @@
+"""
+---- queries.py
+"""
+
+from sqlalchemy import bindparam, text
+
+TIMELINE_KEYSET = """
+        AND (
+            t.created_at < :before_created_at
+            OR (t.created_at = :before_created_at AND t.id < :before_id)
+        )"""
+
+# one index range scan on tweets(user_id, created_at, id) per author, so
+# every tweet comes back exactly once whatever the follow count
+TIMELINE_SQL = """
+        SELECT
+            t.id,
+            t.user_id,
+            t.tweet,
+            t.created_at
+        FROM tweets t
+        WHERE t.user_id IN :user_ids{keyset}
+        ORDER BY t.created_at DESC, t.id DESC{limit}
+    """
+
+TIMELINE_LIMIT = """
+        LIMIT :limit"""
+
+QUERIES = {
+    "get_user": """
+        SELECT
+            id,
+            name,
+            email,
+            profile
+        FROM users
+        WHERE id = :user_id
+    """,
+    "get_credential": """
+        SELECT
+            id,
+            hashed_password
+        FROM users
+        WHERE email = :email
+    """,
+    "insert_user": """
+        INSERT INTO users (
+            name,
+            email,
+            profile,
+            hashed_password
+        ) VALUES (
+            :name,
+            :email,
+            :profile,
+            :password
+        )
+    """,
+    "insert_tweet": """
+        INSERT INTO tweets (
+            user_id,
+            tweet
+        ) VALUES (
+            :id,
+            :tweet
+        )
+    """,
+    # first id of the multi-row insert just run on this connection
+    "get_first_insert_id": """
+        SELECT {first_insert_id}
+    """,
+    "insert_tweet_terms": """
+        {insert_ignore} INTO tweet_terms (
+            term,
+            tweet_id
+        ) VALUES (
+            :term,
+            :tweet_id
+        )
+    """,
+    # search index backfill: the next tweets by id
+    "get_tweet_texts_after": """
+        SELECT id, tweet
+        FROM tweets
+        WHERE id > :after
+        ORDER BY id
+        LIMIT :limit
+    """,
+    "get_term_postings": """
+        SELECT tweet_id
+        FROM tweet_terms
+        WHERE term = :term
+        ORDER BY tweet_id DESC
+        LIMIT :limit
+    """,
+    # postings with their authors (a tweet table shared by several tweet
+    # shards: the author names the tweet's shard)
+    "get_term_posting_authors": """
+        SELECT
+            tweet_terms.tweet_id,
+            tweets.user_id
+        FROM tweet_terms
+        JOIN tweets ON tweets.id = tweet_terms.tweet_id
+        WHERE tweet_terms.term = :term
+        ORDER BY tweet_terms.tweet_id DESC
+        LIMIT :limit
+    """,
+    "insert_queue_checkpoint": """
+        {insert_ignore} INTO tweet_queue_checkpoints (
+            name,
+            position
+        ) VALUES (
+            :name,
+            0
+        )
+    """,
+    "get_queue_position": """
+        SELECT position
+        FROM tweet_queue_checkpoints
+        WHERE name = :name
+    """,
+    "update_queue_checkpoint": """
+        UPDATE tweet_queue_checkpoints
+        SET position = :position
+        WHERE name = :name
+    """,
+    # INSERT ... SELECT skips an unknown user on both dialects (sqlite's
+    # OR IGNORE does not cover foreign key violations)
+    "insert_follow": """
+        {insert_ignore} INTO users_follow_list (
+            user_id,
+            follow_user_id
+        )
+        SELECT
+            :id,
+            u.id
+        FROM users u
+        WHERE u.id = :follow
+    """,
+    "insert_unfollow": """
+        DELETE FROM users_follow_list
+        WHERE user_id = :id
+        AND follow_user_id = :unfollow
+    """,
+    "insert_follows": """
+        {insert_ignore} INTO users_follow_list (
+            user_id,
+            follow_user_id
+        )
+        SELECT
+            :id,
+            u.id
+        FROM users u
+        WHERE u.id IN :follow_user_ids
+    """,
+    "insert_unfollows": """
+        DELETE FROM users_follow_list
+        WHERE user_id = :id
+        AND follow_user_id IN :unfollow_user_ids
+    """,
+    "get_followee_ids": """
+        SELECT follow_user_id
+        FROM users_follow_list
+        WHERE user_id = :user_id
+    """,
+    "get_follower_ids": """
+        SELECT user_id
+        FROM users_follow_list
+        WHERE follow_user_id = :user_id
+        LIMIT :limit
+    """,
+    "get_followee_page": """
+        SELECT follow_user_id
+        FROM users_follow_list
+        WHERE user_id = :user_id
+        AND follow_user_id > :after
+        ORDER BY follow_user_id
+        LIMIT :limit
+    """,
+    "get_follower_page": """
+        SELECT user_id
+        FROM users_follow_list
+        WHERE follow_user_id = :user_id
+        AND user_id > :after
+        ORDER BY user_id
+        LIMIT :limit
+    """,
+    "get_all_follower_ids": """
+        SELECT user_id
+        FROM users_follow_list
+        WHERE follow_user_id = :user_id
+    """,
+    "get_follower_counts": """
+        SELECT
+            follow_user_id,
+            COUNT(*) AS follower_count
+        FROM users_follow_list
+        WHERE follow_user_id IN :user_ids
+        GROUP BY follow_user_id
+    """,
+    # newest tweet per author: MAX per group is one index dive per author
+    # (a loose index scan of tweets(user_id, created_at, id)), not a sort of
+    # every tweet of theirs
+    "get_timeline_heads": """
+        SELECT
+            heads.user_id,
+            heads.created_at,
+            (
+                SELECT MAX(t.id)
+                FROM tweets t
+                WHERE t.user_id = heads.user_id
+                AND t.created_at = heads.created_at
+            ) AS id
+        FROM (
+            SELECT
+                user_id,
+                MAX(created_at) AS created_at
+            FROM tweets
+            WHERE user_id IN :user_ids
+            GROUP BY user_id
+        ) heads
+    """,
+    "get_tweets": """
+        SELECT
+            t.id,
+            t.user_id,
+            t.tweet,
+            t.created_at
+        FROM tweets t
+        WHERE t.id IN :tweet_ids
+        ORDER BY t.created_at DESC, t.id DESC
+    """,
+    "timeline": TIMELINE_SQL.format(keyset="", limit=TIMELINE_LIMIT),
+    "timeline_before": TIMELINE_SQL.format(
+        keyset=TIMELINE_KEYSET, limit=TIMELINE_LIMIT
+    ),
+    # whole timeline, read through a streaming cursor
+    "timeline_stream": TIMELINE_SQL.format(keyset="", limit=""),
+    "timeline_stream_before": TIMELINE_SQL.format(keyset=TIMELINE_KEYSET, limit=""),
+}
+
+# the only spellings that differ between mysql and sqlite
+DIALECT_KEYWORDS = {
+    "mysql": {
+        "insert_ignore": "INSERT IGNORE",
+        "first_insert_id": "LAST_INSERT_ID()",
+    },
+    "sqlite": {
+        "insert_ignore": "INSERT OR IGNORE",
+        "first_insert_id": "last_insert_rowid() - :rowcount + 1",
+    },
+}
+
+EXPANDING = {
+    "insert_follows": ("follow_user_ids",),
+    "insert_unfollows": ("unfollow_user_ids",),
+    "get_follower_counts": ("user_ids",),
+    "get_tweets": ("tweet_ids",),
+    "get_timeline_heads": ("user_ids",),
+    "timeline": ("user_ids",),
+    "timeline_before": ("user_ids",),
+    "timeline_stream": ("user_ids",),
+    "timeline_stream_before": ("user_ids",),
+}
+
+
+def statement(name, dialect="mysql"):
+    """
+    text() construct of the query called name
+    """
+    sql = QUERIES[name]
+    if "{" in sql:
+        sql = sql.format(**DIALECT_KEYWORDS[dialect])
+
+    return text(sql).bindparams(
+        *[bindparam(key, expanding=True) for key in EXPANDING.get(name, ())]
+    )
+
+
+def build_queries(dialect="mysql"):
+    """
+    text() constructs of every query, built once per app
+
+    reusing the same construct lets the engine's compiled cache skip
+    re-parsing and re-compiling the SQL on every call.
+    """
+    return {name: statement(name, dialect) for name in QUERIES}
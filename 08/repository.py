@@ -0,0 +1,489 @@
+"""
+---- repository.py
+
+storage behind the app's query functions: SqlRepository runs the queries of
+queries.py on an engine, MemoryRepository keeps everything in process.
+"""
+
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from heapq import merge
+from itertools import islice
+from threading import RLock
+
+from search import postings_rows, tokenize
+
+# text form of CURRENT_TIMESTAMP, also used by timeline cursors
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class SqlRepository:
+    """
+    Repository on a SQLAlchemy engine (mysql or sqlite)
+    """
+
+    def __init__(self, database, queries):
+        self.database = database
+        self.queries = queries
+
+    def get_user(self, user_id):
+        return self.database.execute(
+            self.queries["get_user"],
+            {"user_id": user_id},
+        ).fetchone()
+
+    def get_credential(self, email):
+        return self.database.execute(
+            self.queries["get_credential"],
+            {"email": email},
+        ).fetchone()
+
+    def insert_user(self, user):
+        return self.database.execute(
+            self.queries["insert_user"],
+            user,
+        ).lastrowid
+
+    def insert_tweet(self, user_id, tweet):
+        with self.database.begin() as connection:
+            tweet_id = connection.execute(
+                self.queries["insert_tweet"],
+                {"id": user_id, "tweet": tweet},
+            ).lastrowid
+            self.index_tweets(connection, [(tweet_id, tweet)])
+
+        return tweet_id
+
+    def insert_tweets(self, user_id, tweets, with_ids=False):
+        """
+        one executemany in a single transaction; returns the row count and,
+        with_ids, the new tweet ids in insert order
+        """
+        with self.database.begin() as connection:
+            tweet_ids = self.insert_tweet_rows(
+                connection, [{"id": user_id, "tweet": tweet} for tweet in tweets]
+            )
+            self.index_tweets(connection, zip(tweet_ids, tweets))
+
+        return len(tweet_ids), tweet_ids if with_ids else []
+
+    def insert_tweet_rows(self, connection, rows):
+        """
+        one multi-row insert of insert_tweet rows in the caller's
+        transaction; the new ids in insert order
+
+        a multi-row insert gets consecutive ids (InnoDB in every
+        innodb_autoinc_lock_mode, as the row count is known up front;
+        sqlite holds the write lock), so they follow from the first one and
+        no concurrent insert can be mistaken for the batch's.
+        """
+        connection.execute(self.queries["insert_tweet"], rows)
+        first_id = connection.execute(
+            self.queries["get_first_insert_id"], {"rowcount": len(rows)}
+        ).scalar()
+
+        return list(range(first_id, first_id + len(rows)))
+
+    def index_tweets(self, connection, tweets):
+        """
+        search postings of (tweet_id, tweet) pairs, in the caller's
+        transaction
+        """
+        rows = postings_rows(tweets)
+        if rows:
+            connection.execute(self.queries["insert_tweet_terms"], rows)
+
+    def index_tweets_after(self, after, limit):
+        """
+        search postings of the next limit tweets by id above after, in one
+        transaction (postings already there are skipped); the last id
+        indexed, or None past the newest tweet
+        """
+        with self.database.begin() as connection:
+            rows = connection.execute(
+                self.queries["get_tweet_texts_after"],
+                {"after": after, "limit": limit},
+            ).fetchall()
+            self.index_tweets(connection, [(row["id"], row["tweet"]) for row in rows])
+
+        return rows[-1]["id"] if rows else None
+
+    def get_term_postings(self, term, limit):
+        """
+        ids of the newest limit tweets containing term, newest first
+        """
+        rows = self.database.execute(
+            self.queries["get_term_postings"],
+            {"term": term, "limit": limit},
+        ).fetchall()
+
+        return [row["tweet_id"] for row in rows]
+
+    def get_term_posting_authors(self, term, limit):
+        """
+        (tweet id, user id) of the newest limit tweets containing term,
+        newest first
+        """
+        rows = self.database.execute(
+            self.queries["get_term_posting_authors"],
+            {"term": term, "limit": limit},
+        ).fetchall()
+
+        return [(row["tweet_id"], row["user_id"]) for row in rows]
+
+    def get_queue_position(self, name):
+        """
+        log position the tweet queue called name has stored up to
+        """
+        with self.database.begin() as connection:
+            connection.execute(self.queries["insert_queue_checkpoint"], {"name": name})
+            return connection.execute(
+                self.queries["get_queue_position"], {"name": name}
+            ).scalar()
+
+    def insert_queued_tweets(self, name, tweets, position):
+        """
+        (position, user_id, tweet) triples of a queue batch and the queue's
+        new position, in one transaction; tweets at or before the stored
+        position are skipped, so a replayed log never stores a tweet twice
+        """
+        with self.database.begin() as connection:
+            stored = connection.execute(
+                self.queries["get_queue_position"], {"name": name}
+            ).scalar()
+            rows = [
+                {"id": user_id, "tweet": tweet}
+                for tweet_position, user_id, tweet in tweets
+                if tweet_position > (stored or 0)
+            ]
+            if rows:
+                tweet_ids = self.insert_tweet_rows(connection, rows)
+                self.index_tweets(
+                    connection, zip(tweet_ids, (row["tweet"] for row in rows))
+                )
+            connection.execute(
+                self.queries["update_queue_checkpoint"],
+                {"name": name, "position": position},
+            )
+
+    def insert_follow(self, user_id, follow_user_id):
+        return self.database.execute(
+            self.queries["insert_follow"],
+            {"id": user_id, "follow": follow_user_id},
+        ).rowcount
+
+    def delete_follow(self, user_id, unfollow_user_id):
+        return self.database.execute(
+            self.queries["insert_unfollow"],
+            {"id": user_id, "unfollow": unfollow_user_id},
+        ).rowcount
+
+    def insert_follows(self, user_id, follow_user_ids):
+        return self.database.execute(
+            self.queries["insert_follows"],
+            {"id": user_id, "follow_user_ids": follow_user_ids},
+        ).rowcount
+
+    def delete_follows(self, user_id, unfollow_user_ids):
+        return self.database.execute(
+            self.queries["insert_unfollows"],
+            {"id": user_id, "unfollow_user_ids": unfollow_user_ids},
+        ).rowcount
+
+    def get_followee_ids(self, user_id):
+        rows = self.database.execute(
+            self.queries["get_followee_ids"],
+            {"user_id": user_id},
+        ).fetchall()
+
+        return [row["follow_user_id"] for row in rows]
+
+    def get_follower_ids(self, user_id, limit=None):
+        if limit is None:
+            query, params = "get_all_follower_ids", {"user_id": user_id}
+        else:
+            query, params = "get_follower_ids", {"user_id": user_id, "limit": limit}
+        rows = self.database.execute(self.queries[query], params).fetchall()
+
+        return [row["user_id"] for row in rows]
+
+    def get_followee_page(self, user_id, after, limit):
+        """
+        limit followee ids of user_id above after, ascending (a keyset
+        range of the primary key)
+        """
+        rows = self.database.execute(
+            self.queries["get_followee_page"],
+            {"user_id": user_id, "after": after, "limit": limit},
+        ).fetchall()
+
+        return [row["follow_user_id"] for row in rows]
+
+    def get_follower_page(self, user_id, after, limit):
+        """
+        limit follower ids of user_id above after, ascending (a keyset
+        range of the (follow_user_id, user_id) index)
+        """
+        rows = self.database.execute(
+            self.queries["get_follower_page"],
+            {"user_id": user_id, "after": after, "limit": limit},
+        ).fetchall()
+
+        return [row["user_id"] for row in rows]
+
+    def get_follower_counts(self, user_ids):
+        rows = self.database.execute(
+            self.queries["get_follower_counts"],
+            {"user_ids": user_ids},
+        ).fetchall()
+
+        return {row["follow_user_id"]: row["follower_count"] for row in rows}
+
+    def get_tweets(self, tweet_ids):
+        return self.database.execute(
+            self.queries["get_tweets"],
+            {"tweet_ids": tweet_ids},
+        ).fetchall()
+
+    def get_timeline(self, user_ids, limit, before=None):
+        params = {"user_ids": user_ids, "limit": limit}
+        if before is not None:
+            params["before_created_at"], params["before_id"] = before
+
+        return self.database.execute(
+            self.queries["timeline" if before is None else "timeline_before"],
+            params,
+        ).fetchall()
+
+    def get_timeline_heads(self, user_ids):
+        """
+        newest tweet (user_id, id, created_at) of each of user_ids who has
+        tweeted; any new tweet of theirs changes one of them
+        """
+        return self.database.execute(
+            self.queries["get_timeline_heads"],
+            {"user_ids": user_ids},
+        ).fetchall()
+
+    def iter_timeline(self, user_ids, before=None, batch_size=500):
+        """
+        every timeline row, newest first, fetched batch_size rows at a time
+        through a server-side cursor where the driver has one
+
+        holds a pooled connection until the generator is exhausted or closed.
+        """
+        params = {"user_ids": user_ids}
+        if before is not None:
+            params["before_created_at"], params["before_id"] = before
+
+        with self.database.connect() as connection:
+            result = connection.execution_options(
+                stream_results=True, yield_per=batch_size
+            ).execute(
+                self.queries[
+                    "timeline_stream" if before is None else "timeline_stream_before"
+                ],
+                params,
+            )
+            yield from result
+
+
+class MemoryRepository:
+    """
+    In-process repository
+
+    tweets are kept per author in append-only lists ordered by
+    (created_at, id); follows as followee and follower adjacency sets;
+    search postings as append-only tweet id lists per term.
+    a timeline is a k-way heap merge of the authors' newest tweets, so its
+    cost follows the page size, not the number of tweets stored.
+    """
+
+    def __init__(self):
+        self.lock = RLock()
+        self.users = {}
+        self.user_ids_by_email = {}
+        self.tweets = {}
+        self.tweets_by_user = {}
+        self.tweet_keys_by_user = {}
+        self.followees = {}
+        self.followers = {}
+        self.postings = {}
+        self.queue_positions = {}
+        self.next_user_id = 1
+        self.next_tweet_id = 1
+
+    def get_user(self, user_id):
+        with self.lock:
+            user = self.users.get(user_id)
+            return dict(user) if user else None
+
+    def get_credential(self, email):
+        with self.lock:
+            user = self.users.get(self.user_ids_by_email.get(email))
+            return dict(user) if user else None
+
+    def insert_user(self, user):
+        with self.lock:
+            if user["email"] in self.user_ids_by_email:
+                raise ValueError(f"duplicate email: {user['email']}")
+
+            user_id = self.next_user_id
+            self.next_user_id += 1
+            self.users[user_id] = {
+                "id": user_id,
+                "name": user["name"],
+                "email": user["email"],
+                "profile": user["profile"],
+                "hashed_password": user["password"],
+            }
+            self.user_ids_by_email[user["email"]] = user_id
+
+            return user_id
+
+    def insert_tweet(self, user_id, tweet):
+        with self.lock:
+            tweet_id = self.next_tweet_id
+            self.next_tweet_id += 1
+            created_at = datetime.now().strftime(TIMESTAMP_FORMAT)
+            row = {
+                "id": tweet_id,
+                "user_id": user_id,
+                "tweet": tweet,
+                "created_at": created_at,
+            }
+            self.tweets[tweet_id] = row
+            self.tweets_by_user.setdefault(user_id, []).append(row)
+            self.tweet_keys_by_user.setdefault(user_id, []).append(
+                (created_at, tweet_id)
+            )
+            for term in tokenize(tweet):
+                self.postings.setdefault(term, []).append(tweet_id)
+
+            return tweet_id
+
+    def insert_tweets(self, user_id, tweets, with_ids=False):
+        with self.lock:
+            tweet_ids = [self.insert_tweet(user_id, tweet) for tweet in tweets]
+
+        return len(tweet_ids), tweet_ids if with_ids else []
+
+    def get_term_postings(self, term, limit):
+        with self.lock:
+            tweet_ids = self.postings.get(term, [])
+            return tweet_ids[: -limit - 1 : -1]
+
+    def get_queue_position(self, name):
+        with self.lock:
+            return self.queue_positions.setdefault(name, 0)
+
+    def insert_queued_tweets(self, name, tweets, position):
+        with self.lock:
+            stored = self.queue_positions.get(name, 0)
+            for tweet_position, user_id, tweet in tweets:
+                if tweet_position > stored:
+                    self.insert_tweet(user_id, tweet)
+            self.queue_positions[name] = position
+
+    def insert_follow(self, user_id, follow_user_id):
+        return self.insert_follows(user_id, [follow_user_id])
+
+    def delete_follow(self, user_id, unfollow_user_id):
+        return self.delete_follows(user_id, [unfollow_user_id])
+
+    def insert_follows(self, user_id, follow_user_ids):
+        with self.lock:
+            if user_id not in self.users:
+                return 0
+
+            followees = self.followees.setdefault(user_id, set())
+            added = 0
+            for follow_user_id in follow_user_ids:
+                if follow_user_id in self.users and follow_user_id not in followees:
+                    followees.add(follow_user_id)
+                    self.followers.setdefault(follow_user_id, set()).add(user_id)
+                    added += 1
+
+            return added
+
+    def delete_follows(self, user_id, unfollow_user_ids):
+        with self.lock:
+            followees = self.followees.get(user_id, set())
+            removed = 0
+            for unfollow_user_id in unfollow_user_ids:
+                if unfollow_user_id in followees:
+                    followees.discard(unfollow_user_id)
+                    self.followers[unfollow_user_id].discard(user_id)
+                    removed += 1
+
+            return removed
+
+    def get_followee_ids(self, user_id):
+        with self.lock:
+            return list(self.followees.get(user_id, ()))
+
+    def get_follower_ids(self, user_id, limit=None):
+        with self.lock:
+            return list(islice(self.followers.get(user_id, ()), limit))
+
+    def get_followee_page(self, user_id, after, limit):
+        with self.lock:
+            followee_ids = sorted(self.followees.get(user_id, ()))
+
+        return followee_ids[bisect_right(followee_ids, after) :][:limit]
+
+    def get_follower_page(self, user_id, after, limit):
+        with self.lock:
+            follower_ids = sorted(self.followers.get(user_id, ()))
+
+        return follower_ids[bisect_right(follower_ids, after) :][:limit]
+
+    def get_follower_counts(self, user_ids):
+        with self.lock:
+            return {
+                user_id: len(self.followers[user_id])
+                for user_id in user_ids
+                if self.followers.get(user_id)
+            }
+
+    def get_tweets(self, tweet_ids):
+        with self.lock:
+            rows = [self.tweets[i] for i in tweet_ids if i in self.tweets]
+
+        return sorted(
+            rows, key=lambda row: (row["created_at"], row["id"]), reverse=True
+        )
+
+    def get_timeline(self, user_ids, limit, before=None):
+        return list(islice(self.iter_timeline(user_ids, before), limit))
+
+    def get_timeline_heads(self, user_ids):
+        with self.lock:
+            return [
+                self.tweets_by_user[user_id][-1]
+                for user_id in user_ids
+                if self.tweets_by_user.get(user_id)
+            ]
+
+    def iter_timeline(self, user_ids, before=None, batch_size=None):
+        """
+        lazy k-way merge; the lists are append-only, so the merge reads the
+        tweets stored when it started without holding the lock
+        """
+        with self.lock:
+            newest_first = []
+            for user_id in user_ids:
+                rows = self.tweets_by_user.get(user_id)
+                if not rows:
+                    continue
+
+                end = len(rows)
+                if before is not None:
+                    end = bisect_left(self.tweet_keys_by_user[user_id], tuple(before))
+                newest_first.append(map(rows.__getitem__, range(end - 1, -1, -1)))
+
+        return merge(
+            *newest_first,
+            key=lambda row: (row["created_at"], row["id"]),
+            reverse=True,
+        )
@@ -0,0 +1,51 @@
+"""
+---- routing.py
+"""
+
+from itertools import cycle
+from threading import Lock
+
+from cache import LRUCache
+
+
+class ReadRouter:
+    """
+    Read routing between the primary and its replicas
+
+    reads go round-robin to the replica repositories; a user who wrote in
+    the last window seconds reads from the primary, so their own writes
+    show up right away whatever the replication lag. the window is kept
+    per process (the app carries it across workers in a cookie).
+    """
+
+    def __init__(self, primary, replicas, window, max_writers=100000):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.next_replica = cycle(self.replicas)
+        self.recent_writers = LRUCache(max_writers, window)
+        self.lock = Lock()
+
+    def reader(self, user_id=None):
+        """
+        repository for a read on behalf of user_id
+        """
+        if not self.replicas or self.pinned(user_id):
+            return self.primary
+
+        with self.lock:
+            return next(self.next_replica)
+
+    def pinned(self, user_id):
+        """
+        whether user_id's reads must go to the primary
+        """
+        return bool(
+            self.replicas and user_id is not None and self.recent_writers.get(user_id)
+        )
+
+    def wrote(self, user_id):
+        """
+        pin user_id's reads to the primary for the next window seconds
+        """
+        if self.replicas:
+            self.recent_writers.set(user_id, True)
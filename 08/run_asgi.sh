@@ -0,0 +1,15 @@
+#!/bin/bash
+
+required_pkg='SQLAlchemy aiomysql aiosqlite bcrypt PyJWT quart hypercorn'
+pkg_list=($required_pkg)
+
+for package in ${pkg_list[@]};
+do
+        if [ -z "$(pip list | grep -i ${package})" ]; then
+                pip install ${package}
+        else
+                echo "${package} already installed"
+        fi
+done
+
+hypercorn "asgi_app:create_asgi_app()" --bind 0.0.0.0:5000
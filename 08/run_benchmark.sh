@@ -0,0 +1,11 @@
+#!/bin/bash
+
+# usage: bash run_benchmark.sh [--users N] [--concurrency N] [--output report.json] ...
+# MINITER_TEST_DB_URL=mysql benchmarks the miniter_test MySQL database instead
+# of the default sqlite file
+
+if [ "${MINITER_TEST_DB_URL}" == "mysql" ]; then
+	bash ./reset_miniter_test_db.sh
+fi
+
+python benchmark.py "$@"
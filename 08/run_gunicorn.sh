@@ -0,0 +1,8 @@
+#!/bin/bash
+
+# production server; install the packages once with
+#   pip install SQLAlchemy mysql-connector-python bcrypt PyJWT flask-cors gunicorn
+
+cd "$(dirname "$0")"
+
+exec gunicorn -c gunicorn.conf.py wsgi:app
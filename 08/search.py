@@ -0,0 +1,61 @@
+"""
+---- search.py
+
+tweet search on an inverted index
+
+every stored tweet adds one (term, tweet_id) posting per distinct term to
+tweet_terms, in the transaction that stores the tweet. a query reads the
+newest max_postings postings of each of its terms (a range scan of the
+(term, tweet_id) primary key), so its cost follows the number of terms, not
+the number of tweets.
+"""
+
+import re
+import unicodedata
+from math import log
+
+WORD = re.compile(r"\w+")
+
+# longest term kept (tweet_terms.term is VARCHAR(64))
+MAX_TERM_LENGTH = 64
+
+
+def tokenize(text):
+    """
+    distinct search terms of text, in order of first appearance:
+    NFKC-normalized, case-folded runs of word characters
+    """
+    terms = WORD.findall(unicodedata.normalize("NFKC", text).casefold())
+
+    return list(dict.fromkeys(term[:MAX_TERM_LENGTH] for term in terms))
+
+
+def postings_rows(tweets):
+    """
+    tweet_terms rows of (tweet_id, tweet) pairs
+    """
+    return [
+        {"term": term, "tweet_id": tweet_id}
+        for tweet_id, tweet in tweets
+        for term in tokenize(tweet)
+    ]
+
+
+def rank(postings, max_postings):
+    """
+    {tweet_id: score} of {term: tweet ids} postings
+
+    a tweet scores the idf-like weight log(1 + max_postings / postings) of
+    every query term it contains: tweets matching more terms, and rarer
+    ones, come first. scores are rounded so they survive a cursor.
+    """
+    scores = {}
+    for tweet_ids in postings.values():
+        if not tweet_ids:
+            continue
+
+        weight = log(1 + max_postings / len(tweet_ids))
+        for tweet_id in tweet_ids:
+            scores[tweet_id] = scores.get(tweet_id, 0.0) + weight
+
+    return {tweet_id: round(score, 6) for tweet_id, score in scores.items()}
@@ -0,0 +1,242 @@
+"""
+---- sharding.py
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from heapq import merge
+from itertools import islice
+from zlib import crc32
+
+
+def timeline_key(row):
+    return (row["created_at"], row["id"])
+
+
+class ShardedRepository:
+    """
+    Repository whose tweets are hash-partitioned by user_id
+
+    users and follows stay in the primary repository; a user's tweets live
+    in shards[shard_of(user_id)], each shard a repository of its own. a
+    tweet's id is its shard-local id * N + shard, unique across shards and
+    naming its shard. a timeline queries the authors' shards concurrently
+    and k-way merges their pages by (created_at, id).
+    """
+
+    def __init__(self, primary, shards, executor=None):
+        self.primary = primary
+        self.shards = list(shards)
+        self.executor = executor or ThreadPoolExecutor(
+            len(self.shards), thread_name_prefix="tweet-shard"
+        )
+
+    def __getattr__(self, name):
+        # everything but tweets is the primary's
+        return getattr(self.primary, name)
+
+    def shard_of(self, user_id):
+        """
+        shard holding user_id's tweets (a stable hash, the same in every
+        process)
+        """
+        return crc32(user_id.to_bytes(8, "big", signed=True)) % len(self.shards)
+
+    def global_id(self, shard, tweet_id):
+        return tweet_id * len(self.shards) + shard
+
+    def global_row(self, shard, row):
+        row = dict(getattr(row, "_mapping", row))
+        row["id"] = self.global_id(shard, row["id"])
+
+        return row
+
+    def shard_before(self, shard, before):
+        """
+        timeline cursor (created_at, global id) in shard-local ids: the
+        local ids below it are those whose global id is below it
+        """
+        if before is None:
+            return None
+
+        created_at, tweet_id = before
+        return created_at, -((shard - tweet_id) // len(self.shards))
+
+    def by_shard(self, user_ids):
+        user_ids_by_shard = {}
+        for user_id in user_ids:
+            user_ids_by_shard.setdefault(self.shard_of(user_id), []).append(user_id)
+
+        return user_ids_by_shard
+
+    def scatter(self, calls):
+        """
+        run {shard: (function, *args)} concurrently; {shard: result}
+        """
+        if len(calls) == 1:
+            ((shard, (function, *args)),) = calls.items()
+            return {shard: function(*args)}
+
+        futures = {shard: self.executor.submit(*call) for shard, call in calls.items()}
+        return {shard: future.result() for shard, future in futures.items()}
+
+    def insert_tweet(self, user_id, tweet):
+        shard = self.shard_of(user_id)
+
+        return self.global_id(shard, self.shards[shard].insert_tweet(user_id, tweet))
+
+    def insert_tweets(self, user_id, tweets, with_ids=False):
+        shard = self.shard_of(user_id)
+        rowcount, tweet_ids = self.shards[shard].insert_tweets(
+            user_id, tweets, with_ids
+        )
+
+        return rowcount, [self.global_id(shard, tweet_id) for tweet_id in tweet_ids]
+
+    def get_term_postings(self, term, limit):
+        """
+        every shard database's newest limit postings of term, merged by id
+
+        a database shared by several shards is queried once; a posting's
+        shard is its author's, as the database does not tell them apart
+        """
+        repositories = list(dict.fromkeys(self.shards))
+        postings = self.scatter(
+            {
+                index: (repository.get_term_posting_authors, term, limit)
+                for index, repository in enumerate(repositories)
+            }
+        )
+
+        return sorted(
+            (
+                self.global_id(self.shard_of(user_id), tweet_id)
+                for authored in postings.values()
+                for tweet_id, user_id in authored
+            ),
+            reverse=True,
+        )[:limit]
+
+    def get_queue_position(self, name):
+        """
+        the oldest of the shards' positions (each shard keeps its own
+        checkpoint, name.shard)
+        """
+        return min(
+            shard.get_queue_position(f"{name}.{index}")
+            for index, shard in enumerate(self.shards)
+        )
+
+    def insert_queued_tweets(self, name, tweets, position):
+        """
+        one transaction per shard; every shard's checkpoint moves, so a
+        shard without tweets in the batch does not hold the replay back
+        """
+        tweets_by_shard = {shard: [] for shard in range(len(self.shards))}
+        for record in tweets:
+            tweets_by_shard[self.shard_of(record[1])].append(record)
+
+        self.scatter(
+            {
+                shard: (
+                    self.shards[shard].insert_queued_tweets,
+                    f"{name}.{shard}",
+                    shard_tweets,
+                    position,
+                )
+                for shard, shard_tweets in tweets_by_shard.items()
+            }
+        )
+
+    def get_tweets(self, tweet_ids):
+        local_ids = {}
+        for tweet_id in tweet_ids:
+            local_id, shard = divmod(tweet_id, len(self.shards))
+            local_ids.setdefault(shard, []).append(local_id)
+
+        rows = self.scatter(
+            {
+                shard: (self.shards[shard].get_tweets, ids)
+                for shard, ids in local_ids.items()
+            }
+        )
+
+        return sorted(
+            (
+                self.global_row(shard, row)
+                for shard, shard_rows in rows.items()
+                for row in shard_rows
+            ),
+            key=timeline_key,
+            reverse=True,
+        )
+
+    def get_timeline(self, user_ids, limit, before=None):
+        """
+        scatter: each shard's newest limit tweets of its authors, queried
+        concurrently; gather: k-way merge of the pages
+        """
+        pages = self.scatter(
+            {
+                shard: (
+                    self.shards[shard].get_timeline,
+                    ids,
+                    limit,
+                    self.shard_before(shard, before),
+                )
+                for shard, ids in self.by_shard(user_ids).items()
+            }
+        )
+
+        return list(
+            islice(
+                merge(
+                    *(
+                        map(partial(self.global_row, shard), page)
+                        for shard, page in pages.items()
+                    ),
+                    key=timeline_key,
+                    reverse=True,
+                ),
+                limit,
+            )
+        )
+
+    def get_timeline_heads(self, user_ids):
+        """
+        newest tweet of each of user_ids, from their shards concurrently
+        """
+        heads = self.scatter(
+            {
+                shard: (self.shards[shard].get_timeline_heads, ids)
+                for shard, ids in self.by_shard(user_ids).items()
+            }
+        )
+
+        return [
+            self.global_row(shard, row) for shard, rows in heads.items() for row in rows
+        ]
+
+    def iter_timeline(self, user_ids, before=None, batch_size=500):
+        """
+        lazy k-way merge of the shards' streamed timelines; holds a
+        connection per shard until exhausted or closed
+        """
+        streams = {
+            shard: self.shards[shard].iter_timeline(
+                ids, self.shard_before(shard, before), batch_size
+            )
+            for shard, ids in self.by_shard(user_ids).items()
+        }
+        try:
+            yield from merge(
+                *(
+                    map(partial(self.global_row, shard), rows)
+                    for shard, rows in streams.items()
+                ),
+                key=timeline_key,
+                reverse=True,
+            )
+        finally:
+            for rows in streams.values():
+                rows.close()
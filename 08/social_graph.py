@@ -0,0 +1,120 @@
+"""
+---- social_graph.py
+"""
+
+from array import array
+from bisect import bisect_left
+from threading import Lock
+
+from cache import LRUCache
+
+
+class SocialGraph:
+    """
+    Followee / follower adjacency cache
+
+    each user's followees and followers are kept as a sorted array of ids,
+    loaded from the repository on first use and updated in place by this
+    process' follows and unfollows. arrays are replaced, never mutated, so
+    a reader keeps a consistent snapshot. entries expire after ttl seconds,
+    which bounds how long other processes' writes stay invisible.
+    """
+
+    def __init__(self, repository, max_users, ttl):
+        self.repository = repository
+        self.followees = LRUCache(max_users, ttl)
+        self.followers = LRUCache(max_users, ttl)
+        self.lock = Lock()
+        self.writes = 0
+
+    def followee_ids(self, user_id):
+        """
+        sorted ids of the users user_id follows
+        """
+        return self.load(self.followees, user_id, self.repository.get_followee_ids)
+
+    def follower_ids(self, user_id):
+        """
+        sorted ids of the users following user_id
+        """
+        return self.load(self.followers, user_id, self.repository.get_follower_ids)
+
+    def cached_follower_ids(self, user_id):
+        """
+        sorted follower ids of user_id if already loaded, else None
+        """
+        return self.followers.get(user_id)
+
+    def is_following(self, user_id, follow_user_id):
+        """
+        whether user_id follows follow_user_id
+        """
+        ids = self.followee_ids(user_id)
+        index = bisect_left(ids, follow_user_id)
+
+        return index < len(ids) and ids[index] == follow_user_id
+
+    def load(self, cache, user_id, fetch):
+        ids = cache.get(user_id)
+        if ids is not None:
+            return ids
+
+        with self.lock:
+            writes = self.writes
+        ids = array("q", sorted(fetch(user_id)))
+
+        # a write that raced the fetch may be missing from it: use the ids
+        # for this call but do not cache them
+        with self.lock:
+            if writes == self.writes:
+                cache.set(user_id, ids)
+
+        return ids
+
+    def follow(self, user_id, follow_user_id):
+        """
+        record a follow the repository has just stored
+        """
+        with self.lock:
+            self.writes += 1
+            self.update(self.followees, user_id, follow_user_id, True)
+            self.update(self.followers, follow_user_id, user_id, True)
+
+    def unfollow(self, user_id, unfollow_user_id):
+        """
+        record an unfollow the repository has just stored
+        """
+        with self.lock:
+            self.writes += 1
+            self.update(self.followees, user_id, unfollow_user_id, False)
+            self.update(self.followers, unfollow_user_id, user_id, False)
+
+    def invalidate(self, user_id, other_user_ids):
+        """
+        forget user_id's followees and the followers of other_user_ids
+        (batch writes, which do not report which rows changed)
+        """
+        with self.lock:
+            self.writes += 1
+            self.followees.invalidate(user_id)
+            for other_user_id in other_user_ids:
+                self.followers.invalidate(other_user_id)
+
+    def update(self, cache, user_id, other_user_id, add):
+        ids = cache.get(user_id)
+        if ids is None:
+            return
+
+        index = bisect_left(ids, other_user_id)
+        present = index < len(ids) and ids[index] == other_user_id
+        if add and not present:
+            ids = ids[:index] + array("q", [other_user_id]) + ids[index:]
+            cache.set(user_id, ids)
+        elif not add and present:
+            cache.set(user_id, ids[:index] + ids[index + 1 :])
+
+    def stats(self):
+        return {
+            "followees": self.followees.stats(),
+            "followers": self.followers.stats(),
+        }
@@ -0,0 +1,192 @@
+"""
+---- storage.py
+"""
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    ForeignKey,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    TIMESTAMP,
+    create_engine,
+    event,
+    func,
+    text,
+)
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import StaticPool
+
+from db_pool import engine_options
+
+# dialect-neutral equivalent of database_setting/sql/create_table.sql
+metadata = MetaData()
+
+users = Table(
+    "users",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("name", String(255), nullable=False),
+    Column("email", String(255), nullable=False, unique=True),
+    Column("hashed_password", String(255), nullable=False),
+    Column("profile", String(2000), nullable=False),
+    Column(
+        "created_at", TIMESTAMP, nullable=False, server_default=func.current_timestamp()
+    ),
+    Column("updated_at", TIMESTAMP, nullable=True),
+)
+
+users_follow_list = Table(
+    "users_follow_list",
+    metadata,
+    Column("user_id", Integer, ForeignKey("users.id"), primary_key=True),
+    Column("follow_user_id", Integer, ForeignKey("users.id"), primary_key=True),
+    Column(
+        "created_at", TIMESTAMP, nullable=False, server_default=func.current_timestamp()
+    ),
+    Index("users_follow_list_follow_user_id_idx", "follow_user_id", "user_id"),
+)
+
+tweets = Table(
+    "tweets",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("user_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("tweet", String(300), nullable=False),
+    Column(
+        "created_at", TIMESTAMP, nullable=False, server_default=func.current_timestamp()
+    ),
+    Index("tweets_user_id_created_at_id_idx", "user_id", "created_at", "id"),
+)
+
+# inverted index of tweets for search: one posting per distinct term
+tweet_terms = Table(
+    "tweet_terms",
+    metadata,
+    Column("term", String(64), primary_key=True),
+    Column("tweet_id", Integer, ForeignKey("tweets.id"), primary_key=True),
+)
+
+# last log position of each write-behind tweet queue stored in tweets
+tweet_queue_checkpoints = Table(
+    "tweet_queue_checkpoints",
+    metadata,
+    Column("name", String(255), primary_key=True),
+    Column("position", BigInteger, nullable=False),
+)
+
+# schema of a tweet shard (database_setting/sql/create_shard_table.sql): the
+# users live in the main database, so tweets carry no foreign key
+shard_metadata = MetaData()
+
+shard_tweets = Table(
+    "tweets",
+    shard_metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("user_id", Integer, nullable=False),
+    Column("tweet", String(300), nullable=False),
+    Column(
+        "created_at", TIMESTAMP, nullable=False, server_default=func.current_timestamp()
+    ),
+    Index("tweets_user_id_created_at_id_idx", "user_id", "created_at", "id"),
+)
+
+tweet_terms.to_metadata(shard_metadata)
+tweet_queue_checkpoints.to_metadata(shard_metadata)
+
+
+def is_sqlite(url):
+    """
+    True for sqlite:// database urls
+    """
+    return make_url(url).get_backend_name() == "sqlite"
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+def sqlite_engine_options(url, config, telemetry):
+    """
+    create_engine keyword arguments for sqlite
+
+    :memory: databases live in one connection, so they get a StaticPool;
+    file databases keep the instrumented pool.
+    """
+    options = {"connect_args": {"check_same_thread": False}}
+    if make_url(url).database in (None, "", ":memory:"):
+        options["poolclass"] = StaticPool
+    else:
+        options.update(engine_options(config, telemetry))
+
+    return options
+
+
+def create_database(config, telemetry, schema=metadata):
+    """
+    engine for DB_URL (mysql or sqlite)
+
+    sqlite databases get their schema (metadata, or shard_metadata for a
+    tweet shard) created on the spot; mysql ones are set up by
+    database_setting/create_db_and_tables.sh and create_shard_dbs.sh.
+    """
+    url = config["DB_URL"]
+    if not is_sqlite(url):
+        return create_engine(url, encoding="utf-8", **engine_options(config, telemetry))
+
+    database = create_engine(url, **sqlite_engine_options(url, config, telemetry))
+    event.listen(database, "connect", set_sqlite_pragmas)
+    schema.create_all(database)
+
+    return database
+
+
+ASYNC_DRIVERS = {"mysql": "mysql+aiomysql", "sqlite": "sqlite+aiosqlite"}
+
+
+async def create_async_database(config):
+    """
+    async engine for ASYNC_DB_URL, or for DB_URL on its async driver
+    (aiomysql for mysql, aiosqlite for sqlite)
+    """
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    if config.get("ASYNC_DB_URL"):
+        url = make_url(config["ASYNC_DB_URL"])
+    else:
+        url = make_url(config["DB_URL"])
+        url = url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+    if url.get_backend_name() != "sqlite":
+        options = engine_options(config, None)
+        options.pop("poolclass")
+        return create_async_engine(url, **options)
+
+    database = create_async_engine(url)
+    event.listen(database.sync_engine, "connect", set_sqlite_pragmas)
+    async with database.begin() as connection:
+        await connection.run_sync(metadata.create_all)
+
+    return database
+
+
+def truncate_tables(database):
+    """
+    empty every table (tests and benchmark)
+    """
+    if database.dialect.name == "sqlite":
+        for table in reversed(metadata.sorted_tables):
+            database.execute(table.delete())
+        return
+
+    database.execute(text("SET FOREIGN_KEY_CHECKS=0"))
+    for table in metadata.sorted_tables:
+        database.execute(text(f"TRUNCATE {table.name}"))
+    database.execute(text("SET FOREIGN_KEY_CHECKS=1"))
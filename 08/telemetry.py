@@ -0,0 +1,142 @@
+"""
+---- telemetry.py
+
+request and SQL timings behind /metrics
+"""
+
+from time import perf_counter
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+from metrics import COUNT_BUCKETS, LabeledHistogram, prometheus_histogram
+
+
+class RequestTelemetry:
+    """
+    Per-route request latency, per-query SQL latency (failed statements
+    apart, by error) and per-request SQL statement counts
+    """
+
+    def __init__(self):
+        self.request_seconds = LabeledHistogram(("endpoint", "method", "status"))
+        self.sql_seconds = LabeledHistogram(("query",))
+        self.sql_error_seconds = LabeledHistogram(("query", "error"))
+        self.request_sql_seconds = LabeledHistogram(("endpoint",))
+        self.request_sql_queries = LabeledHistogram(("endpoint",), COUNT_BUCKETS)
+        self.query_names = {}
+
+    def instrument_app(self, app):
+        """
+        time every request of app
+        """
+        app.before_request(self.start_request)
+        app.after_request(self.end_request)
+
+    def instrument_engine(self, engine, queries):
+        """
+        time every statement run on engine; statements of the queries
+        registry are labelled with their name, anything else as "other"
+        """
+        self.query_names.update(
+            {statement: name for name, statement in queries.items()}
+        )
+        event.listen(engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+        event.listen(engine, "handle_error", self.handle_error)
+
+    def start_request(self):
+        g.request_started_at = perf_counter()
+        g.sql_queries = 0
+        g.sql_seconds = 0.0
+
+    def end_request(self, response):
+        started_at = g.pop("request_started_at", None)
+        if started_at is None:
+            return response
+
+        endpoint = request.endpoint or "unmatched"
+        self.request_seconds.observe(
+            (endpoint, request.method, str(response.status_code)),
+            perf_counter() - started_at,
+        )
+        self.request_sql_queries.observe((endpoint,), g.sql_queries)
+        self.request_sql_seconds.observe((endpoint,), g.sql_seconds)
+
+        return response
+
+    def before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info.setdefault("query_started_at", []).append(perf_counter())
+
+    def after_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        elapsed = perf_counter() - conn.info["query_started_at"].pop()
+        self.sql_seconds.observe((self.query_name(context),), elapsed)
+        self.count_request_sql(elapsed)
+
+    def handle_error(self, exception_context):
+        # a statement that raised never reaches after_cursor_execute; take
+        # its start off the stack, or the next statement is timed from it
+        conn = exception_context.connection
+        started_at = conn.info.get("query_started_at") if conn is not None else None
+        if not started_at:
+            return
+
+        elapsed = perf_counter() - started_at.pop()
+        self.sql_error_seconds.observe(
+            (
+                self.query_name(exception_context.execution_context),
+                type(exception_context.original_exception).__name__,
+            ),
+            elapsed,
+        )
+        self.count_request_sql(elapsed)
+
+    def query_name(self, context):
+        compiled = context.compiled if context is not None else None
+
+        return self.query_names.get(compiled.statement if compiled else None, "other")
+
+    def count_request_sql(self, elapsed):
+        if has_request_context() and "sql_queries" in g:
+            g.sql_queries += 1
+            g.sql_seconds += elapsed
+
+    def prometheus_lines(self):
+        """
+        Prometheus text format lines of every histogram
+        """
+        return [
+            *prometheus_histogram(
+                "miniter_request_seconds",
+                "Request latency by route, method and status.",
+                self.request_seconds.label_names,
+                self.request_seconds.snapshots(),
+            ),
+            *prometheus_histogram(
+                "miniter_sql_query_seconds",
+                "SQL statement latency by query name.",
+                self.sql_seconds.label_names,
+                self.sql_seconds.snapshots(),
+            ),
+            *prometheus_histogram(
+                "miniter_sql_error_seconds",
+                "Latency of failed SQL statements by query name and error.",
+                self.sql_error_seconds.label_names,
+                self.sql_error_seconds.snapshots(),
+            ),
+            *prometheus_histogram(
+                "miniter_request_sql_seconds",
+                "Time spent in SQL per request, by route.",
+                self.request_sql_seconds.label_names,
+                self.request_sql_seconds.snapshots(),
+            ),
+            *prometheus_histogram(
+                "miniter_request_sql_queries",
+                "SQL statements run per request, by route.",
+                self.request_sql_queries.label_names,
+                self.request_sql_queries.snapshots(),
+            ),
+        ]
@@ -2,15 +2,32 @@
 ---- Tweet App Test
 """
 
+import asyncio
+import gzip
 import json
+import os
 import pytest
+import subprocess
+import sys
+import threading
+import time
 import bcrypt
-from sqlalchemy import create_engine, text
+from datetime import datetime
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import IntegrityError
 
 import config
-from app import create_app
+import json_provider
+from flask import g
+from app import READ_PRIMARY_COOKIE, create_app, get_user, reader
+from db_pool import PoolTelemetry
+from home_timeline import HomeTimelineStore
+from password import PasswordHasher
+from queries import statement
+from storage import create_database, truncate_tables
+from tweet_queue import TweetQueue
 
-database = create_engine(config.test_config["DB_URL"], encoding="utf-8", max_overflow=0)
+database = create_database(config.test_config, PoolTelemetry())
 
 
 @pytest.fixture
@@ -25,11 +42,18 @@ def api():
     return api
 
 
+def setup_module():
+    """
+    start from empty tables (the benchmark shares the test database)
+    """
+    truncate_tables(database)
+
+
 def setup_function():
     """
     setup for every test
     """
-    hashed_password = bcrypt.hashpw(b"1111", bcrypt.gensalt())
+    hashed_password = bcrypt.hashpw(b"1111", bcrypt.gensalt()).decode("UTF-8")
     new_user = {
         "id": 1,
         "name": "TaeYeon",
@@ -59,15 +83,89 @@ def setup_function():
     )
 
 
+def insert_users(user_ids):
+    """
+    insert extra users straight into the test database
+    """
+    database.execute(
+        text(
+            """
+        INSERT INTO users (
+            id,
+            name,
+            email,
+            profile,
+            hashed_password
+        ) VALUES (
+            :id,
+            :name,
+            :email,
+            :profile,
+            :hashed_password
+        )
+    """
+        ),
+        [
+            {
+                "id": user_id,
+                "name": f"user{user_id}",
+                "email": f"user{user_id}@gmail.com",
+                "profile": "test",
+                "hashed_password": "x",
+            }
+            for user_id in user_ids
+        ],
+    )
+
+
+def insert_follows(user_id, follow_user_ids):
+    """
+    insert follow rows straight into the test database
+    """
+    database.execute(
+        text(
+            """
+        INSERT INTO users_follow_list (
+            user_id,
+            follow_user_id
+        ) VALUES (
+            :user_id,
+            :follow_user_id
+        )
+    """
+        ),
+        [
+            {"user_id": user_id, "follow_user_id": follow_user_id}
+            for follow_user_id in follow_user_ids
+        ],
+    )
+
+
+def insert_tweets(tweets):
+    """
+    insert (user_id, tweet) pairs straight into the test database
+    """
+    database.execute(
+        text(
+            """
+        INSERT INTO tweets (
+            user_id,
+            tweet
+        ) VALUES (
+            :user_id,
+            :tweet
+        )
+    """
+        ),
+        [{"user_id": user_id, "tweet": tweet} for user_id, tweet in tweets],
+    )
+
+
 def teardown_function():
     """
     teardown for every test
     """
-    database.execute(text("SET FOREIGN_KEY_CHECKS=0"))
-    database.execute(text("TRUNCATE users"))
-    database.execute(text("TRUNCATE tweets"))
-    database.execute(text("TRUNCATE users_follow_list"))
-    database.execute(text("SET FOREIGN_KEY_CHECKS=1"))
+    truncate_tables(database)
 
 
 def test_ping(api):
@@ -78,6 +176,87 @@ def test_ping(api):
     assert b"pong" in resp.data
 
 
+def test_internal_stats(api):
+    """
+    internal stats test
+    """
+    api.get("/timeline/1")
+    resp = api.get("/internal/stats")
+    stats = json.loads(resp.data.decode("utf-8"))
+
+    assert resp.status_code == 200
+    assert stats["db_pool"]["primary"]["checkout_wait_seconds"]["count"] >= 1
+    assert stats["db_pool"]["primary"]["held_seconds"]["count"] >= 1
+    assert stats["db_pool"]["primary"]["timeouts"] == 0
+
+
+def test_metrics(api, caplog):
+    """
+    /metrics exposes request, SQL and bcrypt histograms; login logs no secrets
+    """
+    with caplog.at_level("INFO", logger="miniter"):
+        resp = api.post(
+            "/login",
+            data=json.dumps({"email": "taeyeon@gmail.com", "password": "1111"}),
+            content_type="application/json",
+        )
+        access_token = json.loads(resp.data.decode("utf-8"))["access_token"]
+        resp = api.post(
+            "/login",
+            data=json.dumps({"email": "nobody@gmail.com", "password": "1111"}),
+            content_type="application/json",
+        )
+        assert resp.status_code == 401
+
+    assert "event=login user_id=1" in caplog.text
+    assert "reason=unknown_email" in caplog.text
+    assert "1111" not in caplog.text and access_token not in caplog.text
+
+    api.get("/timeline/1")
+
+    resp = api.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.mimetype == "text/plain"
+    text = resp.data.decode("utf-8")
+    assert "# TYPE miniter_request_seconds histogram" in text
+    assert (
+        'miniter_request_seconds_count{endpoint="login",method="POST",status="200"} 1'
+        in text
+    )
+    assert 'miniter_sql_query_seconds_count{query="get_credential"} 2' in text
+    assert 'miniter_sql_query_seconds_count{query="timeline"} 1' in text
+    assert 'miniter_sql_query_seconds_count{query="get_timeline_heads"} 1' in text
+    assert 'miniter_request_sql_queries_count{endpoint="timeline"} 1' in text
+    assert 'miniter_bcrypt_seconds_count{operation="checkpw"} 1' in text
+    assert 'miniter_db_pool_checkout_seconds_count{pool="primary"}' in text
+    assert 'miniter_db_pool_timeouts_total{pool="primary"} 0' in text
+
+
+def test_metrics_sql_error():
+    """
+    a failed statement is recorded by error and leaves no timer behind
+    """
+    app = create_app(config.test_config)
+    user = {
+        "name": "TaeYeon",
+        "email": "taeyeon@gmail.com",
+        "profile": "singer",
+        "password": "1111",
+    }
+    with pytest.raises(IntegrityError):
+        app.repository.insert_user(user)
+
+    with app.database.connect() as connection:
+        connection.execute(text("SELECT 1"))
+        assert connection.info["query_started_at"] == []
+
+    body = app.test_client().get("/metrics").data.decode("utf-8")
+    assert (
+        'miniter_sql_error_seconds_count{query="insert_user",error="IntegrityError"} 1'
+        in body
+    )
+
+
 def test_sign_up(api):
     """
     sign up test
@@ -97,6 +276,70 @@ def test_sign_up(api):
     assert resp.status_code == 200
 
 
+def test_sign_up_busy():
+    """
+    full password hashing queue must fail fast with 503
+    """
+    app = create_app({**config.test_config, "PASSWORD_HASH_QUEUE_SIZE": 0})
+    api = app.test_client()
+
+    # occupy the only worker slot
+    app.password_hasher.slots.acquire()
+    resp = api.post(
+        "/sign-up",
+        data=json.dumps(
+            {
+                "email": "kim@gmail.com",
+                "password": "1111",
+                "name": "jkkim",
+                "profile": "model",
+            }
+        ),
+        content_type="application/json",
+    )
+    app.password_hasher.slots.release()
+
+    assert resp.status_code == 503
+    assert app.password_hasher.stats()["rejected"] == 1
+
+    # a hash outliving PASSWORD_HASH_TIMEOUT is a 503 too
+    app.password_hasher.rounds = 14
+    app.password_hasher.timeout = 0.01
+    resp = api.post(
+        "/login",
+        data=json.dumps({"email": "taeyeon@gmail.com", "password": "1111"}),
+        content_type="application/json",
+    )
+    assert resp.status_code == 503
+    assert app.password_hasher.stats()["timeouts"] == 1
+
+
+def test_password_hasher_fork():
+    """
+    a forked process hashes on its own pool, never on the parent's pipes
+    """
+    hasher = PasswordHasher(1, 8, 4, timeout=10)
+    hashed = hasher.hash(b"1111")
+    parent_pool = hasher.executor
+
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            checks = [hasher.check(b"1111", hashed) for _ in range(5)]
+            checks += [not hasher.check(b"2222", hashed) for _ in range(5)]
+            if all(checks) and hasher.executor is not parent_pool:
+                status = 0
+            hasher.executor.shutdown()
+        finally:
+            os._exit(status)
+
+    assert [hasher.check(b"2222", hashed) for _ in range(10)] == [False] * 10
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert hasher.executor is parent_pool
+
+
 def test_login(api):
     """
     login test
@@ -133,6 +376,14 @@ def test_tweet(api):
     )
     assert resp.status_code == 200
 
+    resp = api.post(
+        "tweet",
+        data=json.dumps({"tweet": "Please fuck me"}),
+        content_type="application/json",
+        headers={"Authorization": access_token + "x"},
+    )
+    assert resp.status_code == 401
+
     # check tweet
     resp = api.get(f"/timeline/{new_user_id}")
     tweets = json.loads(resp.data.decode("utf-8"))
@@ -141,4 +392,1129 @@ def test_tweet(api):
     assert tweets == {
         "user_id": 1,
         "timeline": [{"user_id": 1, "tweet": "Please fuck me"}],
+        "next_cursor": None,
+    }
+
+
+def test_user_cache():
+    """
+    user profile cache test
+    """
+    app = create_app(config.test_config)
+
+    with app.app_context():
+        assert get_user(1)["name"] == "TaeYeon"
+        assert get_user(1)["name"] == "TaeYeon"
+        assert app.user_cache.stats()["hits"] == 1
+        assert app.user_cache.stats()["misses"] == 1
+
+        g.user_id = 1
+        assert g.user["email"] == "taeyeon@gmail.com"
+
+
+def test_tweet_batch(api):
+    """
+    batch tweet test
+    """
+    resp = api.post(
+        "/login",
+        data=json.dumps({"email": "taeyeon@gmail.com", "password": "1111"}),
+        content_type="application/json",
+    )
+    access_token = json.loads(resp.data.decode("utf-8"))["access_token"]
+
+    resp = api.post(
+        "/tweets:batch",
+        data=json.dumps(
+            {"tweets": [{"tweet": "first"}, {"tweet": "x" * 301}, {"tweet": "third"}]}
+        ),
+        content_type="application/json",
+        headers={"Authorization": access_token},
+    )
+    result = json.loads(resp.data.decode("utf-8"))
+
+    assert resp.status_code == 200
+    assert result["inserted"] == 2
+    assert [r["status"] for r in result["results"]] == [200, 400, 200]
+
+    # a bare array is accepted too; any other body is a 400
+    post = lambda body: api.post(
+        "/tweets:batch",
+        data=json.dumps(body),
+        content_type="application/json",
+        headers={"Authorization": access_token},
+    )
+    resp = post([{"tweet": "fourth"}])
+    assert json.loads(resp.data)["inserted"] == 1
+    assert post("fifth").status_code == 400
+    assert post({"tweet": "sixth"}).status_code == 400
+
+    resp = api.get("/timeline/1")
+    tweets = json.loads(resp.data.decode("utf-8"))["timeline"]
+    assert sorted(t["tweet"] for t in tweets) == ["first", "fourth", "third"]
+
+
+def test_insert_tweets_ids():
+    """
+    batch inserts report the ids of their own rows, in insert order
+    """
+    app = create_app(config.test_config)
+    insert_users([2])
+    insert_tweets([(2, "someone else's")])
+    rowcount, tweet_ids = app.repository.insert_tweets(1, ["a", "b", "c"], True)
+    app.repository.insert_tweet(1, "after")
+
+    assert rowcount == 3
+    tweets = {
+        tweet["id"]: tweet["tweet"] for tweet in app.repository.get_tweets(tweet_ids)
+    }
+    assert [tweets[tweet_id] for tweet_id in tweet_ids] == ["a", "b", "c"]
+
+
+def test_follow_batch(api):
+    """
+    batch follow/unfollow test
+    """
+    insert_users([2, 3, 4])
+    resp = api.post(
+        "/login",
+        data=json.dumps({"email": "taeyeon@gmail.com", "password": "1111"}),
+        content_type="application/json",
+    )
+    access_token = json.loads(resp.data.decode("utf-8"))["access_token"]
+
+    resp = api.post(
+        "/follow",
+        data=json.dumps({"follow": 2}),
+        content_type="application/json",
+        headers={"Authorization": access_token},
+    )
+    assert resp.status_code == 200
+
+    # following twice is a no-op, not a duplicate key error
+    resp = api.post(
+        "/follow",
+        data=json.dumps({"follow": 2}),
+        content_type="application/json",
+        headers={"Authorization": access_token},
+    )
+    assert resp.status_code == 200
+
+    # so is following an unknown user, on every dialect
+    resp = api.post(
+        "/follow",
+        data=json.dumps({"follow": 999}),
+        content_type="application/json",
+        headers={"Authorization": access_token},
+    )
+    assert resp.status_code == 200
+
+    resp = api.post(
+        "/follow:batch",
+        data=json.dumps({"follow": [2, 3, 4, 99]}),
+        content_type="application/json",
+        headers={"Authorization": access_token},
+    )
+    assert json.loads(resp.data.decode("utf-8")) == {"changed": 2}
+
+    resp = api.post(
+        "/unfollow:batch",
+        data=json.dumps({"unfollow": [3, 4, 5]}),
+        content_type="application/json",
+        headers={"Authorization": access_token},
+    )
+    assert json.loads(resp.data.decode("utf-8")) == {"changed": 2}
+
+    resp = api.post(
+        "/follow:batch",
+        data=json.dumps({"follow": "2"}),
+        content_type="application/json",
+        headers={"Authorization": access_token},
+    )
+    assert resp.status_code == 400
+
+
+@pytest.mark.parametrize("backend", ["sql", "memory"])
+def test_follow_list_pages(api, backend):
+    """
+    follow lists are keyset paginated without the graph cache
+    """
+    if backend == "memory":
+        app = create_app({**config.test_config, "STORAGE_BACKEND": "memory"})
+        for user_id in range(1, 6):
+            app.repository.insert_user(
+                {
+                    "name": f"user{user_id}",
+                    "email": f"user{user_id}@gmail.com",
+                    "profile": "test",
+                    "password": "x",
+                }
+            )
+        app.repository.insert_follows(1, [5, 3, 2])
+        app.repository.insert_follows(4, [2])
+        api = app.test_client()
+    else:
+        insert_users([2, 3, 4, 5])
+        insert_follows(1, [5, 3, 2])
+        insert_follows(4, [2])
+
+    following = lambda query="": json.loads(api.get(f"/users/1/following{query}").data)
+    assert following("?limit=2") == {"user_id": 1, "following": [2, 3], "next_after": 3}
+    assert following("?limit=2&after=3") == {
+        "user_id": 1,
+        "following": [5],
+        "next_after": None,
+    }
+    assert following("?limit=3")["next_after"] is None
+    followers = json.loads(api.get("/users/2/followers?limit=1").data)
+    assert followers == {"user_id": 2, "followers": [1], "next_after": 1}
+    followers = json.loads(api.get("/users/2/followers?after=1").data)
+    assert followers["followers"] == [4]
+
+
+def test_social_graph():
+    """
+    follow lists are served from the graph cache and kept current by follows
+    """
+    app = create_app({**config.test_config, "SOCIAL_GRAPH_ENABLED": True})
+    api = app.test_client()
+    insert_users([2, 3, 4])
+    insert_follows(1, [3])
+    resp = api.post(
+        "/login",
+        data=json.dumps({"email": "taeyeon@gmail.com", "password": "1111"}),
+        content_type="application/json",
+    )
+    access_token = json.loads(resp.data.decode("utf-8"))["access_token"]
+
+    following = lambda query="": json.loads(api.get(f"/users/1/following{query}").data)
+    assert following() == {"user_id": 1, "following": [3], "next_after": None}
+
+    for path, payload in (
+        ("/follow", {"follow": 4}),
+        ("/follow", {"follow": 2}),
+        ("/unfollow", {"unfollow": 3}),
+    ):
+        api.post(
+            path,
+            data=json.dumps(payload),
+            content_type="application/json",
+            headers={"Authorization": access_token},
+        )
+
+    assert following()["following"] == [2, 4]
+    assert following("?limit=1") == {"user_id": 1, "following": [2], "next_after": 2}
+    assert following("?limit=1&after=2")["following"] == [4]
+    assert app.social_graph.is_following(1, 4)
+    assert not app.social_graph.is_following(1, 3)
+
+    resp = api.get("/users/4/followers")
+    assert json.loads(resp.data)["followers"] == [1]
+    assert json.loads(api.get("/users/3/followers").data)["followers"] == []
+
+    assert api.get("/users/99/following").status_code == 404
+    assert api.get("/users/1/following?after=x").status_code == 400
+
+
+def test_read_replica(tmp_path):
+    """
+    reads go to the replica except for a user who has just written
+    """
+    app = create_app(
+        {
+            **config.test_config,
+            "DB_REPLICA_URLS": [
+                f"sqlite:///{tmp_path / 'replica1.db'}",
+                f"sqlite:///{tmp_path / 'replica2.db'}",
+            ],
+            "READ_YOUR_WRITES_SECONDS": 0.5,
+        }
+    )
+    api = app.test_client()
+    resp = api.post(
+        "/login",
+        data=json.dumps({"email": "taeyeon@gmail.com", "password": "1111"}),
+        content_type="application/json",
+    )
+    access_token = json.loads(resp.data.decode("utf-8"))["access_token"]
+
+    resp = api.post(
+        "/tweet",
+        data=json.dumps({"tweet": "on the primary"}),
+        content_type="application/json",
+        headers={"Authorization": access_token},
+    )
+    assert resp.status_code == 200
+
+    # the replica never sees the write (nothing replicates between the files)
+    def timeline(api, path="/timeline/1", **kwargs):
+        page = json.loads(api.get(path, **kwargs).data)
+        return [t["tweet"] for t in page["timeline"]]
+
+    auth = {"Authorization": access_token}
+    assert timeline(api, "/timeline", headers=auth) == ["on the primary"]
+    assert timeline(app.test_client()) == []
+
+    time.sleep(0.6)
+    assert timeline(api, "/timeline", headers=auth) == []
+
+    # one replica per request, whatever the number of reads
+    with app.test_request_context("/timeline/1"):
+        assert reader() is reader() is reader()
+        assert reader() is not app.repository
+
+    # the writer's next request lands on another worker: the cookie set by
+    # the write pins its reads there too (and is no access token)
+    worker = create_app(app.config)
+    resp = api.post(
+        "/tweet",
+        data=json.dumps({"tweet": "on the primary again"}),
+        content_type="application/json",
+        headers=auth,
+    )
+    name, token = resp.headers["Set-Cookie"].split(";")[0].split("=", 1)
+    assert name == READ_PRIMARY_COOKIE
+    assert timeline(worker.test_client()) == []
+    other_api = worker.test_client()
+    other_api.set_cookie("localhost", name, token)
+    assert timeline(other_api)[0] == "on the primary again"
+    resp = other_api.get("/timeline", headers={"Authorization": token})
+    assert resp.status_code == 401
+
+    time.sleep(0.6)
+    assert timeline(other_api) == []
+
+    # each engine reports its own pool
+    pools = json.loads(api.get("/internal/stats").data)["db_pool"]
+    assert sorted(pools) == ["primary", "replica0", "replica1"]
+    assert all(pool["checkout_wait_seconds"]["count"] for pool in pools.values())
+
+    for replica in app.replica_databases + worker.replica_databases:
+        replica.dispose()
+
+
+def test_tweet_queue_group_fsync(tmp_path, monkeypatch):
+    """
+    concurrent enqueues share fsyncs, and none returns before its own
+    """
+    synced = []
+    fsync = os.fsync
+
+    def slow_fsync(fd):
+        time.sleep(0.02)
+        synced.append(os.fstat(fd).st_size)
+        fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", slow_fsync)
+    queue = TweetQueue(str(tmp_path), "tweets", None)
+    queue.file = open(queue.segment_path(0), "ab")
+
+    sizes = []
+
+    def enqueue(i):
+        position = queue.enqueue(1, f"tweet {i}")
+        # the fsync that let enqueue return covered its record
+        sizes.append((position, max(synced)))
+
+    threads = [threading.Thread(target=enqueue, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(sizes) == 20
+    assert all(position <= size for position, size in sizes)
+    assert len(synced) < 20
+    queue.file.close()
+
+
+class DownRepository:
+    """
+    repository whose database is down for the tweet queue
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+
+    def get_queue_position(self, name):
+        raise ConnectionError("database is down")
+
+
+def test_tweet_queue_open_failure(tmp_path):
+    """
+    a queue that cannot open releases its lock and stores synchronously
+    """
+    app = create_app(
+        {
+            **config.test_config,
+            "TWEET_QUEUE_ENABLED": True,
+            "TWEET_QUEUE_DIR": str(tmp_path),
+        }
+    )
+    app.tweet_queue.repository = DownRepository(app.repository)
+    api = app.test_client()
+    assert api.get("/ping").status_code == 200
+    assert not app.tweet_queue.started()
+    assert app.tweet_queue.lock_file is None
+
+    resp = api.post(
+        "/login",
+        data=json.dumps({"email": "taeyeon@gmail.com", "password": "1111"}),
+        content_type="application/json",
+    )
+    access_token = json.loads(resp.data.decode("utf-8"))["access_token"]
+    resp = api.post(
+        "/tweet",
+        data=json.dumps({"tweet": "stored right away"}),
+        content_type="application/json",
+        headers={"Authorization": access_token},
+    )
+    assert resp.status_code == 200
+
+    # the lock is free for a process whose database is up
+    queue = TweetQueue(str(tmp_path), "tweets", app.repository)
+    assert queue.ensure_started()
+    queue.close()
+
+
+class PoisonRepository:
+    """
+    repository that rejects every batch holding the tweet "poison"
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+
+    def get_queue_position(self, name):
+        return self.repository.get_queue_position(name)
+
+    def insert_queued_tweets(self, name, tweets, position):
+        if any(tweet == "poison" for *_, tweet in tweets):
+            raise ValueError("rejected")
+        self.repository.insert_queued_tweets(name, tweets, position)
+
+
+def test_tweet_queue_dead_letter(tmp_path):
+    """
+    a tweet the database keeps rejecting is dead-lettered, not retried forever
+    """
+    app = create_app(config.test_config)
+    queue = TweetQueue(
+        str(tmp_path),
+        "tweets",
+        PoisonRepository(app.repository),
+        max_delay=0.01,
+        fsync=False,
+        max_retries=2,
+    )
+    queue.ensure_started()
+    for tweet in ["before", "poison", "after"]:
+        queue.enqueue(1, tweet)
+
+    assert queue.flush(timeout=10)
+    queue.close()
+    assert queue.stats()["dead_lettered"] == 1
+    with open(tmp_path / "tweets.dead.jsonl") as f:
+        assert [json.loads(line)["tweet"] for line in f] == ["poison"]
+    timeline = app.repository.get_timeline([1], 10)
+    assert sorted(row["tweet"] for row in timeline) == ["after", "before"]
+
+
+def test_tweet_queue_not_owner(tmp_path):
+    """
+    a worker that does not own the queue's log stores tweets synchronously
+    """
+    owner = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import fcntl, sys, time\n"
+            f"f = open({str(tmp_path / 'tweets.lock')!r}, 'w')\n"
+            "fcntl.lockf(f, fcntl.LOCK_EX)\n"
+            "print('locked', flush=True)\n"
+            "time.sleep(60)\n",
+        ],
+        stdout=subprocess.PIPE,
+    )
+    try:
+        assert owner.stdout.readline() == b"locked\n"
+        app = create_app(
+            {
+                **config.test_config,
+                "TWEET_QUEUE_ENABLED": True,
+                "TWEET_QUEUE_DIR": str(tmp_path),
+            }
+        )
+        api = app.test_client()
+        assert api.get("/ping").status_code == 200
+        assert not app.tweet_queue.started()
+
+        resp = api.post(
+            "/login",
+            data=json.dumps({"email": "taeyeon@gmail.com", "password": "1111"}),
+            content_type="application/json",
+        )
+        access_token = json.loads(resp.data.decode("utf-8"))["access_token"]
+        resp = api.post(
+            "/tweet",
+            data=json.dumps({"tweet": "stored right away"}),
+            content_type="application/json",
+            headers={"Authorization": access_token},
+        )
+        assert resp.status_code == 200
+        timeline = json.loads(api.get("/timeline/1").data)["timeline"]
+        assert [t["tweet"] for t in timeline] == ["stored right away"]
+    finally:
+        owner.kill()
+        owner.wait()
+
+
+def test_tweet_shards(tmp_path):
+    """
+    tweets are spread over the shards by user_id and merged back in order
+    """
+    insert_users([2, 3, 4])
+    insert_follows(1, [2, 3, 4])
+    shard_urls = [f"sqlite:///{tmp_path / f'shard{i}.db'}" for i in (0, 1)]
+    app = create_app(
+        {
+            **config.test_config,
+            "TWEET_SHARD_URLS": shard_urls,
+            "TWEET_SHARD_COUNT": 4,
+        }
+    )
+    api = app.test_client()
+    repository = app.repository
+    tweet_ids = [repository.insert_tweet(1 + i % 4, f"tweet {i}") for i in range(8)]
+    assert len(set(tweet_ids)) == 8
+
+    stored = [
+        shard.execute(text("SELECT COUNT(*) FROM tweets")).scalar()
+        for shard in app.shard_databases
+    ]
+    assert sum(stored) == 8 and all(stored)
+    assert database.execute(text("SELECT COUNT(*) FROM tweets")).scalar() == 0
+
+    everything = json.loads(api.get("/timeline/1?limit=8").data)["timeline"]
+    assert sorted(t["tweet"] for t in everything) == [f"tweet {i}" for i in range(8)]
+
+    pages, cursor = [], None
+    while True:
+        path = "/timeline/1?limit=3" + (f"&before={cursor}" if cursor else "")
+        page = json.loads(api.get(path).data)
+        pages += page["timeline"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert pages == everything
+    assert [t["tweet"] for t in repository.get_tweets(tweet_ids[:2])] == [
+        t["tweet"] for t in everything if t["tweet"] in ("tweet 0", "tweet 1")
+    ]
+
+    # two shards per database: every posting comes back once, under the
+    # global id of its author's shard (and again after a backfill)
+    def searched():
+        page = json.loads(api.get("/search?q=tweet&limit=100").data)
+        return sorted(t["tweet"] for t in page["results"])
+
+    assert searched() == [f"tweet {i}" for i in range(8)]
+    assert sorted(repository.get_term_postings("tweet", 100)) == sorted(tweet_ids)
+    for shard in app.shard_databases:
+        shard.execute(text("DELETE FROM tweet_terms"))
+    assert searched() == []
+    result = app.test_cli_runner().invoke(args=["backfill-search"])
+    assert result.exit_code == 0, result.output
+    assert searched() == [f"tweet {i}" for i in range(8)]
+
+    # a replayed queue batch skips what each shard already stored
+    assert repository.get_queue_position("q") == 0
+    repository.insert_queued_tweets("q", [(1, 1, "a"), (2, 2, "b")], 2)
+    repository.insert_queued_tweets("q", [(1, 1, "a"), (2, 2, "b"), (3, 3, "c")], 3)
+    assert repository.get_queue_position("q") == 3
+    queued = [t["tweet"] for t in repository.get_timeline([1, 2, 3], 20)]
+    assert sorted(t for t in queued if len(t) == 1) == ["a", "b", "c"]
+
+    # a new tweet can get a lower global id than the newest one (same
+    # second, another shard); the etag must change all the same
+    etag = api.get("/timeline/1").headers["ETag"]
+    for i in range(8):
+        repository.insert_tweet(1 + i % 4, f"etag {i}")
+        assert api.get("/timeline/1").headers["ETag"] != etag
+        etag = api.get("/timeline/1").headers["ETag"]
+
+    with pytest.raises(ValueError):
+        create_app(
+            {
+                **config.test_config,
+                "TWEET_SHARD_URLS": shard_urls,
+                "HOME_TIMELINE_ENABLED": True,
+            }
+        )
+
+    for shard in app.shard_databases:
+        shard.dispose()
+
+
+def test_tweet_queue(tmp_path):
+    """
+    write-behind tweets answer 202, are stored in batches and replayed once
+    """
+    queue_config = {
+        **config.test_config,
+        "TWEET_QUEUE_ENABLED": True,
+        "TWEET_QUEUE_DIR": str(tmp_path),
+        "TWEET_QUEUE_MAX_DELAY": 0.01,
     }
+    app = create_app(queue_config)
+    api = app.test_client()
+    resp = api.post(
+        "/login",
+        data=json.dumps({"email": "taeyeon@gmail.com", "password": "1111"}),
+        content_type="application/json",
+    )
+    access_token = json.loads(resp.data.decode("utf-8"))["access_token"]
+
+    ids = []
+    for i in range(3):
+        resp = api.post(
+            "/tweet",
+            data=json.dumps({"tweet": f"queued {i}"}),
+            content_type="application/json",
+            headers={"Authorization": access_token},
+        )
+        assert resp.status_code == 202
+        ids.append(json.loads(resp.data)["id"])
+    assert ids == sorted(ids)
+
+    assert app.tweet_queue.flush(timeout=5)
+    timeline = lambda api: [
+        t["tweet"] for t in json.loads(api.get("/timeline/1").data)["timeline"]
+    ]
+    assert timeline(api) == ["queued 2", "queued 1", "queued 0"]
+    assert "miniter_tweet_queue_depth 0" in api.get("/metrics").data.decode()
+    app.tweet_queue.close()
+
+    # a crash after the log append: the next process replays the log
+    queue = TweetQueue(str(tmp_path), "tweets", app.repository)
+    queue.open()
+    queue.enqueue(1, "replayed")
+    queue.close()
+
+    for _ in range(2):
+        app = create_app(queue_config)
+        api = app.test_client()
+        assert app.tweet_queue is not None
+        api.get("/ping")
+        assert app.tweet_queue.flush(timeout=5)
+        assert timeline(api) == ["replayed", "queued 2", "queued 1", "queued 0"]
+        app.tweet_queue.close()
+
+
+@pytest.mark.parametrize("backend", ["sql", "memory"])
+def test_search(backend):
+    """
+    search ranks tweets matching more (and rarer) terms first, then newer
+    """
+    app = create_app({**config.test_config, "STORAGE_BACKEND": backend})
+    api = app.test_client()
+    if backend == "memory":
+        api.post(
+            "/sign-up",
+            data=json.dumps(
+                {
+                    "name": "TaeYeon",
+                    "email": "taeyeon@gmail.com",
+                    "password": "1111",
+                    "profile": "singer",
+                }
+            ),
+            content_type="application/json",
+        )
+    resp = api.post(
+        "/login",
+        data=json.dumps({"email": "taeyeon@gmail.com", "password": "1111"}),
+        content_type="application/json",
+    )
+    access_token = json.loads(resp.data.decode("utf-8"))["access_token"]
+    for tweet in ["Hello, World!", "hello there", "big world news", "unrelated"]:
+        api.post(
+            "/tweet",
+            data=json.dumps({"tweet": tweet}),
+            content_type="application/json",
+            headers={"Authorization": access_token},
+        )
+
+    resp = api.get("/search?q=WORLD+hello")
+    page = json.loads(resp.data)
+    assert resp.status_code == 200
+    assert page["query"] == ["world", "hello"]
+    assert [t["tweet"] for t in page["results"]] == [
+        "Hello, World!",
+        "big world news",
+        "hello there",
+    ]
+    assert page["next_cursor"] is None
+
+    found, cursor = [], None
+    while True:
+        page = json.loads(
+            api.get(
+                "/search?q=world+hello&limit=1" + (f"&after={cursor}" if cursor else "")
+            ).data
+        )
+        found += [t["tweet"] for t in page["results"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert found == ["Hello, World!", "big world news", "hello there"]
+
+    assert json.loads(api.get("/search?q=nothing").data)["results"] == []
+    assert api.get("/search?q=%20!").status_code == 400
+    assert api.get("/search?q=hello&after=bad").status_code == 400
+
+
+def test_backfill_search(api):
+    """
+    backfill-search indexes tweets stored before the index, and reruns
+    """
+    insert_tweets([(1, f"old tweet {i}") for i in range(5)])
+    assert json.loads(api.get("/search?q=old").data)["results"] == []
+
+    app = create_app(config.test_config)
+    for _ in range(2):
+        result = app.test_cli_runner().invoke(
+            args=["backfill-search", "--batch-size", "2"]
+        )
+        assert result.exit_code == 0, result.output
+
+    results = json.loads(api.get("/search?q=old&limit=10").data)["results"]
+    assert sorted(t["tweet"] for t in results) == [f"old tweet {i}" for i in range(5)]
+
+
+def test_timeline_pagination(api):
+    """
+    timeline keyset pagination test
+    """
+    insert_tweets([(1, f"tweet {i}") for i in range(5)])
+
+    resp = api.get("/timeline/1?limit=2")
+    page = json.loads(resp.data.decode("utf-8"))
+
+    assert resp.status_code == 200
+    assert [t["tweet"] for t in page["timeline"]] == ["tweet 4", "tweet 3"]
+    assert page["next_cursor"] is not None
+
+    tweets = [t["tweet"] for t in page["timeline"]]
+    while page["next_cursor"]:
+        resp = api.get(f"/timeline/1?limit=2&before={page['next_cursor']}")
+        page = json.loads(resp.data.decode("utf-8"))
+        tweets += [t["tweet"] for t in page["timeline"]]
+
+    assert tweets == [f"tweet {i}" for i in reversed(range(5))]
+
+    resp = api.get("/timeline/1?limit=0")
+    assert resp.status_code == 400
+
+    resp = api.get("/timeline/1?before=garbage")
+    assert resp.status_code == 400
+
+
+def test_timeline_stream(api):
+    """
+    NDJSON timeline streams every tweet in chunks and resumes from a cursor
+    """
+    api.application.config["TIMELINE_STREAM_BATCH_SIZE"] = 2
+    insert_tweets([(1, f"tweet {i}") for i in range(5)])
+
+    resp = api.get("/timeline/1?stream=1")
+    assert resp.status_code == 200
+    assert resp.mimetype == "application/x-ndjson"
+    assert resp.is_streamed
+    lines = [json.loads(line) for line in resp.data.decode("utf-8").splitlines()]
+    assert [line["tweet"] for line in lines] == [
+        f"tweet {i}" for i in reversed(range(5))
+    ]
+
+    resp = api.get(
+        f"/timeline/1?before={lines[1]['cursor']}",
+        headers={"Accept": "application/x-ndjson"},
+    )
+    assert [json.loads(line)["tweet"] for line in resp.data.splitlines()] == [
+        "tweet 2",
+        "tweet 1",
+        "tweet 0",
+    ]
+
+    resp = api.get("/timeline/1?stream=1&before=bogus")
+    assert resp.status_code == 400
+
+
+def test_timeline_etag(api):
+    """
+    timeline answers 304 until a visible tweet or the follow list changes
+    """
+    insert_users([2])
+    insert_tweets([(1, "tweet 0")])
+
+    resp = api.get("/timeline/1")
+    etag = resp.headers["ETag"]
+    assert resp.status_code == 200
+    assert resp.last_modified is not None
+
+    resp = api.get("/timeline/1", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.headers["ETag"] == etag
+    assert resp.data == b""
+
+    assert api.get("/timeline/1?limit=1").headers["ETag"] != etag
+
+    insert_tweets([(2, "tweet of 2")])
+    resp = api.get("/timeline/1", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+
+    insert_follows(1, [2])
+    resp = api.get("/timeline/1", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert [t["tweet"] for t in json.loads(resp.data)["timeline"]] == [
+        "tweet of 2",
+        "tweet 0",
+    ]
+    etag = resp.headers["ETag"]
+
+    insert_tweets([(1, "tweet 1")])
+    resp = api.get("/timeline/1", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+
+
+def test_compression():
+    """
+    large JSON and streamed NDJSON timelines are gzipped on request
+    """
+    app = create_app(
+        {**config.test_config, "COMPRESSION_ENABLED": True, "COMPRESSION_MIN_SIZE": 256}
+    )
+    api = app.test_client()
+    insert_tweets([(1, f"tweet {i}") for i in range(20)])
+
+    resp = api.get("/timeline/1", headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in resp.headers["Vary"]
+    page = json.loads(gzip.decompress(resp.data))
+    assert len(page["timeline"]) == 20
+
+    resp = api.get("/timeline/1?limit=1", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in resp.headers
+
+    resp = api.get("/timeline/1")
+    assert "Content-Encoding" not in resp.headers
+
+    resp = api.get("/timeline/1?stream=1", headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+    lines = gzip.decompress(resp.data).decode("utf-8").splitlines()
+    assert len(lines) == 20
+
+
+def test_timeline_no_duplicates(api):
+    """
+    own tweets must not repeat once per followee
+    """
+    insert_users([2, 3])
+    insert_follows(1, [2, 3])
+    insert_tweets([(1, "mine"), (2, "from 2"), (3, "from 3")])
+
+    resp = api.get("/timeline/1")
+    tweets = json.loads(resp.data.decode("utf-8"))["timeline"]
+
+    assert resp.status_code == 200
+    assert sorted(t["tweet"] for t in tweets) == ["from 2", "from 3", "mine"]
+
+
+def test_timeline_query_plan():
+    """
+    timeline query must stay an index range scan, never a full scan
+    """
+    insert_users(range(2, 22))
+    insert_follows(1, [2, 3])
+    insert_tweets(
+        [(user_id, f"tweet {i}") for user_id in range(1, 22) for i in range(20)]
+    )
+
+    dialect = database.dialect.name
+    explain = "EXPLAIN QUERY PLAN " if dialect == "sqlite" else "EXPLAIN "
+    plan = database.execute(
+        text(explain + statement("timeline_before", dialect).text).bindparams(
+            bindparam("user_ids", expanding=True)
+        ),
+        {
+            "user_ids": [1, 2, 3],
+            "before_created_at": "2038-01-01 00:00:00",
+            "before_id": 2 ** 31 - 1,
+            "limit": 51,
+        },
+    ).fetchall()
+
+    for row in plan:
+        if dialect == "sqlite":
+            assert not row["detail"].startswith("SCAN"), f"full scan: {row}"
+        else:
+            assert row["type"] != "ALL", f"full scan in timeline query plan: {row}"
+
+
+def test_timeline_heads_query_plan():
+    """
+    the ETag probe reads the newest tweet per author off the index, without
+    sorting (or scanning) their tweets
+    """
+    insert_users(range(2, 22))
+    insert_tweets(
+        [(user_id, f"tweet {i}") for user_id in range(1, 22) for i in range(20)]
+    )
+
+    dialect = database.dialect.name
+    explain = "EXPLAIN QUERY PLAN " if dialect == "sqlite" else "EXPLAIN "
+    plan = database.execute(
+        text(explain + statement("get_timeline_heads", dialect).text).bindparams(
+            bindparam("user_ids", expanding=True)
+        ),
+        {"user_ids": [1, 2, 3]},
+    ).fetchall()
+
+    for row in plan:
+        if dialect == "sqlite":
+            assert "TEMP B-TREE" not in row["detail"], f"sort: {row}"
+            assert not row["detail"].startswith("SCAN t"), f"full scan: {row}"
+        else:
+            assert "filesort" not in (row["Extra"] or ""), f"sort: {row}"
+            assert row["type"] != "ALL" or row["table"].startswith("<derived")
+
+    heads = database.execute(
+        statement("get_timeline_heads", dialect), {"user_ids": [1, 2, 99]}
+    ).fetchall()
+    newest = database.execute(
+        text("SELECT user_id, MAX(id) AS id FROM tweets GROUP BY user_id")
+    ).fetchall()
+    newest = {row["user_id"]: row["id"] for row in newest}
+    assert sorted((row["user_id"], row["id"]) for row in heads) == [
+        (1, newest[1]),
+        (2, newest[2]),
+    ]
+
+
+def test_home_timeline_fan_out(api):
+    """
+    fan-out-on-write timeline must match the fan-out-on-read one
+    """
+    app = create_app(
+        {
+            **config.test_config,
+            "HOME_TIMELINE_ENABLED": True,
+            "CELEBRITY_FOLLOWER_THRESHOLD": 2,
+        }
+    )
+    fan_out_api = app.test_client()
+
+    insert_users([2, 3, 4])
+    insert_follows(1, [2, 3])
+    insert_follows(4, [3])
+    insert_tweets([(2, "old from 2"), (3, "old from 3")])
+
+    resp = api.post(
+        "/login",
+        data=json.dumps({"email": "taeyeon@gmail.com", "password": "1111"}),
+        content_type="application/json",
+    )
+    access_token = json.loads(resp.data.decode("utf-8"))["access_token"]
+
+    # materialize user 1's home timeline, then write through the fan-out path
+    resp = fan_out_api.get("/timeline/1")
+    assert resp.status_code == 200
+
+    resp = fan_out_api.post(
+        "/tweet",
+        data=json.dumps({"tweet": "new from 1"}),
+        content_type="application/json",
+        headers={"Authorization": access_token},
+    )
+    assert resp.status_code == 200
+    insert_tweets([(3, "new from celebrity 3")])
+
+    for limit in (1, 2, 50):
+        expected = json.loads(api.get(f"/timeline/1?limit={limit}").data)
+        actual = json.loads(fan_out_api.get(f"/timeline/1?limit={limit}").data)
+
+        assert sorted(t["tweet"] for t in actual["timeline"]) == sorted(
+            t["tweet"] for t in expected["timeline"]
+        )
+
+    # a timeline expiring right after it is built is still served
+    for ttl in (0, 1e-9):
+        app = create_app(
+            {
+                **config.test_config,
+                "HOME_TIMELINE_ENABLED": True,
+                "HOME_TIMELINE_TTL": ttl,
+            }
+        )
+        resp = app.test_client().get("/timeline/1")
+        assert resp.status_code == 200
+        assert len(json.loads(resp.data)["timeline"]) == 4
+
+
+def test_home_timeline_expires():
+    """
+    materialized home timelines and celebrity marks expire and are bounded
+    """
+    store = HomeTimelineStore(10, max_users=2, ttl=0.05, max_celebrities=2)
+
+    store.put(1, [3, 2, 1])
+    store.put(2, [2])
+    store.put(3, [3])
+    assert store.get(1) is None
+    assert store.get(3) == ([3], True)
+
+    store.mark_celebrities([1, 2, 3])
+    assert store.celebrities_in([1, 2, 3]) == {2, 3}
+
+    time.sleep(0.1)
+    assert store.get(3) is None
+    assert store.celebrities_in([1, 2, 3]) == set()
+
+    # a ttl of 0 keeps them until evicted
+    store = HomeTimelineStore(10, ttl=0)
+    assert store.put(1, [2, 1]) == ([2, 1], True)
+    assert store.get(1) == ([2, 1], True)
+
+
+def test_memory_backend():
+    """
+    in-memory repository serves the same API without a database
+    """
+    app = create_app({**config.test_config, "STORAGE_BACKEND": "memory"})
+    api = app.test_client()
+
+    tokens = {}
+    for name in ("kim", "lee", "park"):
+        resp = api.post(
+            "/sign-up",
+            data=json.dumps(
+                {
+                    "email": f"{name}@gmail.com",
+                    "password": "1111",
+                    "name": name,
+                    "profile": "test",
+                }
+            ),
+            content_type="application/json",
+        )
+        assert resp.status_code == 200
+
+        resp = api.post(
+            "/login",
+            data=json.dumps({"email": f"{name}@gmail.com", "password": "1111"}),
+            content_type="application/json",
+        )
+        tokens[name] = json.loads(resp.data.decode("utf-8"))["access_token"]
+
+    for name, tweets in (("kim", 2), ("lee", 3), ("park", 4)):
+        for i in range(tweets):
+            api.post(
+                "/tweet",
+                data=json.dumps({"tweet": f"{name} {i}"}),
+                content_type="application/json",
+                headers={"Authorization": tokens[name]},
+            )
+
+    resp = api.post(
+        "/follow:batch",
+        data=json.dumps({"follow": [2, 3]}),
+        content_type="application/json",
+        headers={"Authorization": tokens["kim"]},
+    )
+    assert json.loads(resp.data.decode("utf-8")) == {"changed": 2}
+
+    page = json.loads(api.get("/timeline/1?limit=4").data.decode("utf-8"))
+    tweets = [t["tweet"] for t in page["timeline"]]
+    while page["next_cursor"]:
+        page = json.loads(
+            api.get(f"/timeline/1?limit=4&before={page['next_cursor']}").data
+        )
+        tweets += [t["tweet"] for t in page["timeline"]]
+
+    assert tweets[:4] == ["park 3", "park 2", "park 1", "park 0"]
+    assert sorted(tweets) == sorted(
+        [f"kim {i}" for i in range(2)]
+        + [f"lee {i}" for i in range(3)]
+        + [f"park {i}" for i in range(4)]
+    )
+
+
+def test_asgi_app():
+    """
+    async serving mode logs in, tweets and pages the timeline
+    """
+    asgi_app = pytest.importorskip("asgi_app")
+
+    async def run():
+        app = asgi_app.create_asgi_app(config.test_config)
+        async with app.test_app() as test_app:
+            api = test_app.test_client()
+
+            resp = await api.post(
+                "/login", json={"email": "taeyeon@gmail.com", "password": "1111"}
+            )
+            assert resp.status_code == 200
+            access_token = (await resp.get_json())["access_token"]
+
+            resp = await api.post("/tweet", json={"tweet": "async tweet"})
+            assert resp.status_code == 401
+
+            for i in range(3):
+                resp = await api.post(
+                    "/tweet",
+                    json={"tweet": f"async tweet {i}"},
+                    headers={"Authorization": access_token},
+                )
+                assert resp.status_code == 200
+
+            resp = await api.get("/timeline", headers={"Authorization": access_token})
+            page = await resp.get_json()
+            assert [t["tweet"] for t in page["timeline"]] == [
+                "async tweet 2",
+                "async tweet 1",
+                "async tweet 0",
+            ]
+
+            resp = await api.get("/timeline/1?limit=2")
+            page = await resp.get_json()
+            assert len(page["timeline"]) == 2
+            resp = await api.get(f"/timeline/1?limit=2&before={page['next_cursor']}")
+            page = await resp.get_json()
+            assert [t["tweet"] for t in page["timeline"]] == ["async tweet 0"]
+            assert page["next_cursor"] is None
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("accelerated", [True, False])
+def test_json_provider(monkeypatch, accelerated):
+    """
+    orjson and the stdlib fallback write the same JSON
+    """
+    if not accelerated:
+        monkeypatch.setattr(json_provider, "orjson", None)
+    elif json_provider.orjson is None:
+        pytest.skip("orjson is not installed")
+
+    app = create_app(config.test_config)
+    with app.app_context():
+        payload = {"ids": {3}, "at": datetime(2020, 1, 2, 3, 4, 5), "name": "한글"}
+        assert json.loads(app.json.dumps(payload)) == {
+            "ids": [3],
+            "at": "2020-01-02 03:04:05",
+            "name": "한글",
+        }
+        assert app.json.loads(b'{"a": [1, 2]}') == {"a": [1, 2]}
+
+        resp = app.json.response(payload)
+        assert resp.mimetype == "application/json"
+        assert json.loads(resp.data)["ids"] == [3]
@@ -0,0 +1,494 @@
+"""
+---- tweet_queue.py
+
+write-behind tweet ingestion
+
+POST /tweet appends the tweet to a local append-only log and answers right
+away; a writer thread stores the log in batches, one multi-row transaction
+per batch (group commit). each transaction also moves the queue's
+checkpoint in tweet_queue_checkpoints, so after a crash the log is replayed
+from exactly where the database left off.
+
+the log is a series of segment files of JSON lines. a tweet's queue id is
+its log position: segment number << SEGMENT_BITS | end offset in the segment.
+"""
+
+import json
+import logging
+import os
+from collections import deque
+from itertools import islice
+from threading import Condition, Thread
+from time import sleep, time
+
+from metrics import Histogram, LATENCY_BUCKETS
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SEGMENT_BITS = 40
+BATCH_SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 5000)
+LAG_BUCKETS = LATENCY_BUCKETS + (30.0, 60.0, 300.0)
+
+LOCK_RETRY_SECONDS = 5
+
+logger = logging.getLogger("miniter")
+
+
+class TweetQueueLocked(RuntimeError):
+    """
+    raised when another process owns the queue's log directory
+    """
+
+
+class TweetQueue:
+    """
+    Durable write-behind queue of tweets
+
+    one process at a time owns a log directory (an exclusive lock file
+    enforces it); the others store their tweets synchronously.
+    """
+
+    def __init__(
+        self,
+        directory,
+        name,
+        repository,
+        batch_size=500,
+        max_delay=0.05,
+        segment_bytes=64 * 1024 * 1024,
+        fsync=True,
+        on_commit=None,
+        max_retries=5,
+    ):
+        self.directory = directory
+        self.name = name
+        self.repository = repository
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.on_commit = on_commit
+        self.max_retries = max_retries
+
+        self.condition = Condition()
+        self.pending = deque()
+        # group fsync: records appended and made durable so far, and
+        # whether a thread is running the fsync covering the others
+        self.sync_condition = Condition()
+        self.appended = 0
+        self.synced = 0
+        self.syncing = False
+        self.file = None
+        self.lock_file = None
+        self.segment = 0
+        self.offset = 0
+        self.thread = None
+        self.pid = None
+        self.stopping = False
+        self.lock_retry_at = 0
+
+        self.committed = 0
+        self.batches = 0
+        self.failures = 0
+        self.dead_lettered = 0
+        self.commit_lag = Histogram(LAG_BUCKETS)
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"{self.name}.{segment:08d}.log")
+
+    def segments(self):
+        """
+        numbers of the segment files on disk, oldest first
+        """
+        prefix, suffix = f"{self.name}.", ".log"
+        return sorted(
+            int(filename[len(prefix) : -len(suffix)])
+            for filename in os.listdir(self.directory)
+            if filename.startswith(prefix) and filename.endswith(suffix)
+        )
+
+    def open(self):
+        """
+        lock the log directory, replay what the database has not stored yet
+        and open the newest segment for appends
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self.lock_file = open(os.path.join(self.directory, f"{self.name}.lock"), "w")
+        if fcntl is not None:
+            # a record lock, unlike flock, is not inherited by forked children
+            # (the password hashing pool) that outlive close()
+            try:
+                fcntl.lockf(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self.lock_file.close()
+                self.lock_file = None
+                raise TweetQueueLocked(
+                    f"tweet queue {self.name} in {self.directory} is in use "
+                    "by another process"
+                )
+
+        position = self.repository.get_queue_position(self.name)
+        committed_segment = position >> SEGMENT_BITS
+        committed_offset = position & ((1 << SEGMENT_BITS) - 1)
+
+        self.segment = committed_segment
+        for segment in self.segments():
+            if segment < committed_segment:
+                os.remove(self.segment_path(segment))
+                continue
+
+            self.segment = segment
+            self.replay(
+                segment, committed_offset if segment == committed_segment else 0
+            )
+
+        self.file = open(self.segment_path(self.segment), "ab")
+        self.offset = self.file.tell()
+        if self.segment == committed_segment and self.offset < committed_offset:
+            # the segment is shorter than the checkpoint (the log was lost):
+            # new positions must stay past it
+            self.rotate()
+
+    def replay(self, segment, start):
+        """
+        queue the records of segment after offset start; a torn last
+        record (a crash mid-append) is cut off
+        """
+        path = self.segment_path(segment)
+        with open(path, "rb") as f:
+            data = f.read()
+
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            with open(path, "r+b") as f:
+                f.truncate(end)
+
+        offset = start
+        for line in data[start:end].splitlines(keepends=True):
+            offset += len(line)
+            record = json.loads(line)
+            self.pending.append(
+                (
+                    segment << SEGMENT_BITS | offset,
+                    record["user_id"],
+                    record["tweet"],
+                    record["queued_at"],
+                )
+            )
+
+    def ensure_started(self):
+        """
+        open the log and start the writer in this process, once (also
+        after a fork, whose child has no writer thread); False while
+        another process owns the log directory
+
+        a process that lost the lock tries again every LOCK_RETRY_SECONDS,
+        so a worker takes over once the owner exits (e.g. recycled).
+        """
+        if self.started():
+            return True
+
+        with self.condition:
+            if self.started():
+                return True
+            if time() < self.lock_retry_at:
+                return False
+
+            if self.file is None:
+                try:
+                    self.open()
+                except TweetQueueLocked:
+                    if self.lock_retry_at == 0:
+                        logger.info(
+                            "event=tweet_queue_not_owner queue=%s pid=%s",
+                            self.name,
+                            os.getpid(),
+                        )
+                    self.lock_retry_at = time() + LOCK_RETRY_SECONDS
+                    return False
+                except Exception:
+                    # e.g. the database is down: let go of the lock and
+                    # store synchronously until the next try
+                    logger.exception(
+                        "event=tweet_queue_open_failed queue=%s", self.name
+                    )
+                    self.release()
+                    self.lock_retry_at = time() + LOCK_RETRY_SECONDS
+                    return False
+            self.stopping = False
+            self.thread = Thread(target=self.run, name="tweet-queue", daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+            return True
+
+    def started(self):
+        """
+        whether this process owns the log and runs its writer
+        """
+        return self.pid == os.getpid() and self.thread is not None
+
+    def enqueue(self, user_id, tweet):
+        """
+        append a tweet to the log (durably, with fsync) and return its
+        queue id
+
+        the append holds the lock, the fsync does not: concurrent enqueues
+        share one fsync (sync) instead of queueing behind one each.
+        """
+        queued_at = time()
+        line = (
+            json.dumps(
+                {"user_id": user_id, "tweet": tweet, "queued_at": queued_at},
+                ensure_ascii=False,
+            ).encode("UTF-8")
+            + b"\n"
+        )
+
+        with self.condition:
+            if self.offset >= self.segment_bytes:
+                self.rotate()
+
+            self.file.write(line)
+            self.file.flush()
+            self.offset += len(line)
+            self.appended += 1
+            appended = self.appended
+
+            position = self.segment << SEGMENT_BITS | self.offset
+            self.pending.append((position, user_id, tweet, queued_at))
+            self.condition.notify_all()
+
+        if self.fsync:
+            self.sync(appended)
+
+        return position
+
+    def sync(self, appended):
+        """
+        wait until the first appended records are on disk
+
+        leader/follower group fsync: the first waiter fsyncs everything
+        appended so far while later ones wait; one fsync covers them all.
+        """
+        with self.sync_condition:
+            while self.syncing and self.synced < appended:
+                self.sync_condition.wait()
+            if self.synced >= appended:
+                return
+            self.syncing = True
+
+        synced = None
+        try:
+            with self.condition:
+                target = self.appended
+                # a duplicate descriptor survives a concurrent rotate()
+                fd = os.dup(self.file.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            synced = target
+        finally:
+            with self.sync_condition:
+                self.syncing = False
+                if synced is not None:
+                    self.synced = max(self.synced, synced)
+                self.sync_condition.notify_all()
+
+    def rotate(self):
+        """
+        start a new segment (caller holds the condition)
+        """
+        if self.fsync:
+            # later fsyncs only see the new segment
+            os.fsync(self.file.fileno())
+            with self.sync_condition:
+                self.synced = max(self.synced, self.appended)
+                self.sync_condition.notify_all()
+        self.file.close()
+        self.segment += 1
+        self.file = open(self.segment_path(self.segment), "ab")
+        self.offset = 0
+
+    def next_batch(self):
+        """
+        wait for a batch: batch_size tweets, or whatever is queued once the
+        oldest has waited max_delay seconds; None when stopping and empty
+        """
+        with self.condition:
+            while not self.pending:
+                if self.stopping:
+                    return None
+                self.condition.wait()
+
+            deadline = self.pending[0][3] + self.max_delay
+            while len(self.pending) < self.batch_size and not self.stopping:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            return list(islice(self.pending, self.batch_size))
+
+    def run(self):
+        """
+        writer thread: store batches until stopped and drained
+        """
+        backoff = 0.1
+        attempts = 0
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+
+            position = batch[-1][0]
+            tweets = [record[:3] for record in batch]
+            try:
+                self.repository.insert_queued_tweets(self.name, tweets, position)
+            except Exception:
+                logger.exception("event=tweet_queue_commit_failed queue=%s", self.name)
+                with self.condition:
+                    self.failures += 1
+                attempts += 1
+                # a batch failing again and again may hold a tweet the
+                # database rejects: store it tweet by tweet instead
+                if attempts < self.max_retries or not self.store_one_by_one(batch):
+                    sleep(backoff)
+                    backoff = min(backoff * 2, 5.0)
+                    continue
+            backoff = 0.1
+            attempts = 0
+
+            committed_at = time()
+            with self.condition:
+                for _ in batch:
+                    self.pending.popleft()
+                self.committed += len(batch)
+                self.batches += 1
+                self.condition.notify_all()
+            self.batch_sizes.observe(len(batch))
+            for *_, queued_at in batch:
+                self.commit_lag.observe(committed_at - queued_at)
+
+            for segment in self.segments():
+                if segment >= position >> SEGMENT_BITS:
+                    break
+                os.remove(self.segment_path(segment))
+
+            if self.on_commit is not None:
+                try:
+                    self.on_commit({user_id for _, user_id, _, _ in batch})
+                except Exception:
+                    logger.exception("event=tweet_queue_on_commit_failed")
+
+    def store_one_by_one(self, batch):
+        """
+        store a failing batch one tweet per transaction; a tweet whose
+        insert fails while the checkpoint alone can still move past it is
+        rejected for good and goes to the dead-letter file. False (retry
+        later) when the database itself is failing.
+        """
+        for position, user_id, tweet, queued_at in batch:
+            try:
+                self.repository.insert_queued_tweets(
+                    self.name, [(position, user_id, tweet)], position
+                )
+                continue
+            except Exception as e:
+                error = e
+
+            try:
+                self.repository.insert_queued_tweets(self.name, [], position)
+            except Exception:
+                return False
+
+            logger.error(
+                "event=tweet_queue_dead_letter queue=%s position=%s user_id=%s "
+                "error=%r",
+                self.name,
+                position,
+                user_id,
+                error,
+            )
+            with open(self.dead_letter_path(), "a", encoding="UTF-8") as f:
+                f.write(
+                    json.dumps(
+                        {
+                            "position": position,
+                            "user_id": user_id,
+                            "tweet": tweet,
+                            "queued_at": queued_at,
+                            "error": str(error),
+                        },
+                        ensure_ascii=False,
+                    )
+                    + "\n"
+                )
+            with self.condition:
+                self.dead_lettered += 1
+
+        return True
+
+    def dead_letter_path(self):
+        return os.path.join(self.directory, f"{self.name}.dead.jsonl")
+
+    def flush(self, timeout=None):
+        """
+        wait until every queued tweet is stored; False on timeout
+        """
+        deadline = None if timeout is None else time() + timeout
+        with self.condition:
+            while self.pending:
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+
+        return True
+
+    def close(self):
+        """
+        store what is queued, stop the writer and release the log
+        """
+        thread = self.thread
+        if thread is not None and self.pid == os.getpid():
+            with self.condition:
+                self.stopping = True
+                self.condition.notify_all()
+            thread.join()
+
+        with self.condition:
+            self.release()
+            self.thread = None
+            self.pid = None
+
+    def release(self):
+        """
+        close the log and give up the lock (caller holds the condition)
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+        self.pending.clear()
+
+    def stats(self):
+        """
+        depth, lag of the oldest queued tweet and writer counters
+        """
+        with self.condition:
+            return {
+                "depth": len(self.pending),
+                "lag_seconds": time() - self.pending[0][3] if self.pending else 0.0,
+                "committed": self.committed,
+                "batches": self.batches,
+                "failures": self.failures,
+                "dead_lettered": self.dead_lettered,
+            }